@@ -26,26 +26,194 @@ dir = "/tmp/sagecell"
 
 # Parameters for heartbeat channels checking whether a given kernel is alive.
 # Setting first_beat lower than 1.0 may cause JavaScript errors.
+# Quiet kernels are pinged less often, up to every max_beat_interval seconds.
 beat_interval = 0.5
 first_beat = 1.0
+max_beat_interval = 8.0
 
 # Allowed idling between interactions with a kernel
 max_timeout = 60 * 15
 # Even an actively used kernel will be killed after this time
 max_lifespan = 60 * 30
+# Kernels of sessions with interacts that are idle for this many seconds are
+# stopped, the session is restored by replaying its code into a new kernel
+# when the user comes back, set to None to disable
+hibernate_after = 60 * 10
+# Output of autoevaluated permalinks (/?q=...) can be recorded on the first
+# view and replayed to later visitors without starting a kernel. A kernel is
+# started once the user evaluates the code again or uses an interact. Only
+# enable this if permalinked code gives the same output every time.
+# Number of permalinks to keep output for, 0 to disable
+permalink_output_cache = 0
+# Recorded output is dropped after this many seconds
+permalink_output_ttl = 60 * 60 * 24
+# Output larger than this many bytes, including files, is not recorded
+permalink_output_max_size = 1 << 23
+# Computations running longer than this (wall-clock seconds) are interrupted,
+# set to None to disable
+max_execution_time = 60 * 2
+# Kernels that can be reused (see max_reuse below) are stopped if they do not
+# finish cleaning up in this many seconds
+reset_timeout = 5
+
+# Kernel requests are rejected with "503 Service Unavailable" if this many
+# requests are already waiting or if they cannot be served within the
+# given number of seconds
+max_queue_depth = 100
+max_queue_wait = 30
+
+# Providers that have not reported for this many seconds are considered dead,
+# their pending requests are sent to other providers
+provider_timeout = 10
+
+# If a kernel request is not served within this percentile of recent
+# allocation times (but at least hedge_min_delay seconds), it is sent to
+# another provider as well and the first kernel to arrive is used.
+# Set to None to disable hedging.
+hedge_percentile = None
+hedge_min_delay = 0.5
+
+# Port of the HAProxy agent-check listener reporting the free kernel capacity
+# of this server as its weight, e.g. 8887, None to disable
+haproxy_agent_port = None
 
 # Recommended settings for kernel providers
 provider_settings = {
     "max_kernels": 10,
-    "max_preforked": 1,
-    # The keys to resource_limits can be any available resources
-    # for the resource module. See http://docs.python.org/library/resource.html
-    # for more information (section 35.13.1)
-    # RLIMIT_AS is more of a suggestion than a hard limit in Mac OS X
-    # Also, Sage may allocate huge AS, making this limit pointless:
-    # https://groups.google.com/d/topic/sage-devel/1MM7UPcrW18/discussion
-    "preforked_rlimits": {
-        "RLIMIT_CPU": 30, # CPU time in seconds
+    # The arrival rate of requests for each profile (see below) is averaged
+    # over prefork_window seconds.
+    "prefork_window": 60,
+    # Maximal number of kernels starting at the same time (None to use the
+    # number of CPUs of the provider host)
+    "max_forking": None,
+    # Import everything kernels need before forking them (zygote mode)
+    "zygote": True,
+    # Code run by providers before forking kernels, so that kernels do not
+    # pay the cost of the first use. Durations and memory growth are logged.
+    # Do not start external interfaces (e.g. gap or maxima via pexpect) here,
+    # forked kernels would share their processes.
+    "warmup": [
+        "from sage.plot.all import plot; plot(1, (0, 1))",
+        "from sage.all import latex, var; latex(var('x')**2 / 2)",
+        "import numpy, scipy.linalg",
+        ],
+    # Freeze objects of the provider after warm-up (gc.freeze) to keep more
+    # memory shared with kernels
+    "freeze_heap": False,
+    # How often (in seconds) to measure memory used by kernels
+    "memory_report_interval": 60,
+    # How often (in seconds) providers report their load even if unchanged
+    "report_interval": 2,
+    # Kernels requested with cacheable setup code are forked from a zygote
+    # process that has run this code once. Each provider keeps up to this
+    # many idle zygotes, dropping the least recently used ones.
+    "max_prepared": 4,
+    # Zygotes that have not run their setup code within this many seconds are
+    # killed and the requests waiting for them fail.
+    "setup_timeout": 30,
+    # Kernels are requested by profile name, each profile has its own pool.
+    # - "rlimits": the keys can be any available resources
+    #   for the resource module. See http://docs.python.org/library/resource.html
+    #   for more information (section 35.13.1)
+    #   RLIMIT_AS is more of a suggestion than a hard limit in Mac OS X
+    #   Also, Sage may allocate huge AS, making this limit pointless:
+    #   https://groups.google.com/d/topic/sage-devel/1MM7UPcrW18/discussion
+    # - the pool of preforked kernels grows from "min_preforked" up to
+    #   "max_preforked" to cover requests expected while a new kernel is forked
+    # - "warmup": code run in each kernel after forking, before it is pooled,
+    #   e.g. to start the interpreter of an external interface
+    # - "language": requests for cells in this language use this profile
+    #   unless a profile is given explicitly
+    # - "lifespan": replaces max_lifespan for kernels of this profile
+    # - "sage": set to False for plain Python kernels that do not load Sage
+    # - "max_reuse": how many times a kernel can be reset after use and given
+    #   out again instead of forking a new one (0 by default). Reset clears the
+    #   namespace, interacts, and files, but modified modules and the like
+    #   stay, so only use it where users do not need isolation from each other.
+    #   Each user gets the full RLIMIT_CPU, kernels that cannot give the next
+    #   one that much anymore are stopped instead of reused
+    # - "max_rss": kernels using more memory (bytes) are not reused
+    # - "public": set to False for profiles used only by the server itself,
+    #   clients cannot request them
+    # - "keep_connected": how many reset kernels the web server keeps
+    #   connected to deal them again right away, e.g. for sequential /service
+    #   requests; they are stopped after max_timeout seconds without use.
+    #   Needs "max_reuse", e.g. 20 and 4 for the service profile
+    "profiles": {
+        "default": {
+            "language": "sage",
+            "rlimits": {
+                "RLIMIT_CPU": 30, # CPU time in seconds
+                },
+            "min_preforked": 1,
+            "max_preforked": 10,
+            },
+        # Single computations via /service
+        "service": {
+            "rlimits": {"RLIMIT_CPU": 10},
+            "min_preforked": 1,
+            "max_preforked": 5,
+            "max_reuse": 0,
+            "max_rss": 1 << 30,
+            },
+        # Long running interacts, e.g. embedded in course pages
+        "interact": {
+            "rlimits": {"RLIMIT_CPU": 60},
+            "min_preforked": 0,
+            "max_preforked": 5,
+            "lifespan": 60 * 60 * 2,
+            },
+        # Lightweight pools for cells in other languages
+        "python": {
+            "language": "python",
+            "sage": False,
+            "rlimits": {"RLIMIT_CPU": 30},
+            "min_preforked": 1,
+            "max_preforked": 5,
+            },
+        "gap": {
+            "language": "gap",
+            "rlimits": {"RLIMIT_CPU": 30},
+            "warmup": ["from sage.interfaces.gap import gap; gap.eval('1')"],
+            "min_preforked": 0,
+            "max_preforked": 2,
+            },
+        "gp": {
+            "language": "gp",
+            "rlimits": {"RLIMIT_CPU": 30},
+            "warmup": ["from sage.interfaces.gp import gp; gp.eval('1')"],
+            "min_preforked": 0,
+            "max_preforked": 2,
+            },
+        "maxima": {
+            "language": "maxima",
+            "rlimits": {"RLIMIT_CPU": 30},
+            "warmup": [
+                "from sage.interfaces.maxima import maxima; maxima.eval('1')"],
+            "min_preforked": 0,
+            "max_preforked": 2,
+            },
+        "r": {
+            "language": "r",
+            "rlimits": {"RLIMIT_CPU": 30},
+            "warmup": ["from sage.interfaces.r import r; r.eval('1')"],
+            "min_preforked": 0,
+            "max_preforked": 2,
+            },
+        # Tab completion kernel of the web server, lives as long as it does
+        "completer": {
+            "public": False,
+            "rlimits": {},
+            "min_preforked": 0,
+            "max_preforked": 0,
+            },
+        # Reserved kernel for deep health checks (/health?deep=true)
+        "health": {
+            "public": False,
+            "rlimits": {},
+            "min_preforked": 0,
+            "max_preforked": 0,
+            },
         },
     }
 
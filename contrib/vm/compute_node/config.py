@@ -9,10 +9,12 @@ requires_tos = False
 
 pid_file = '/home/{server}/sagecell.pid'
 
+haproxy_agent_port = {agent_port}
+
 config_default.provider_settings.update({
     "max_kernels": 80,
-    "max_preforked": 10,
     })
+config_default.provider_settings["profiles"]["default"]["max_preforked"] = 10
 
 config_default.provider_info.update({
     "username": "{worker}",
@@ -47,6 +47,10 @@ users = {"group": "sagecell", "GID": 8888,
          "server": "sc_serv", "server_ID": 8888,
          "worker": "sc_work", "worker_ID": 9999}
 
+# Port of the agent-check listener of compute nodes, set as their
+# haproxy_agent_port
+agent_port = 8887
+
 # Github repositories as (user, repository, branch)
 repositories = [
     ("sagemath", "sage", "master"),
@@ -523,7 +527,7 @@ defaults
         timeout tunnel 30m
 """
 
-# {suffix} {port} {hostname} {peer_port} have to be set once
+# {suffix} {port} {hostname} {peer_port} {agent_port} have to be set once
 # lines with {node} and {id} should be repeated for each server
 HAProxy_section = r"""
 frontend http{suffix}
@@ -548,9 +552,9 @@ backend compute{suffix}
     stick match req.hdr(Jupyter-Kernel-ID)
     stick store-response res.hdr(Jupyter-Kernel-ID)
     stick match path bytes(8,36) if { path_reg ^/kernel/.{36}/ }
-    option httpchk
+    option httpchk GET /health
 
-    server {node} {ip}:8888 id {id} check
+    server {node} {ip}:8888 id {id} check weight 100 agent-check agent-port {agent_port} agent-inter 2s
 """
 
 HAProxy_stats = """
@@ -787,7 +791,7 @@ def install_config_files():
     def adjust_names(file):
         with open(file) as f:
             content = f.read()
-        for key, value in users.items():
+        for key, value in dict(users, agent_port=agent_port).items():
             content = content.replace("{%s}" % key, str(value))
         with open(file, "w") as f:
             f.write(content)
@@ -1039,6 +1043,9 @@ class SCLXC(object):
 def restart_haproxy(names, backup_names=[]):
     r"""
     Regenerate HA-Proxy configuration file and restart it.
+    
+    Compute servers report their free kernel capacity as weight to the
+    agent checks, see ``haproxy_agent_port`` of the web server.
     """
     log.debug("generating HAProxy configuration file")
     lines = [HAProxy_header]
@@ -1048,6 +1055,7 @@ def restart_haproxy(names, backup_names=[]):
         for k, v in {"port" : 80,
                      "suffix": "",
                      "peer_port": 1080,
+                     "agent_port": agent_port,
                      "hostname": check_output("hostname").strip()}.items():
             section = section.replace("{" + k + "}", str(v))
         for l in section.splitlines():
@@ -1070,6 +1078,7 @@ def restart_haproxy(names, backup_names=[]):
                      "ip": tester.ip(),
                      "id": 1,
                      "peer_port": 1088,
+                     "agent_port": agent_port,
                      "hostname": check_output("hostname").strip()}.items():
             section = section.replace("{" + k + "}", str(v))
         lines.append(section)
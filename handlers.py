@@ -1,7 +1,9 @@
 import asyncio
 import base64
 import collections
+import hashlib
 import json
+import mimetypes
 import os.path
 import re
 import time
@@ -16,6 +18,7 @@ import tornado.websocket
 import sockjs.tornado
 from zmq.utils import jsonapi
 
+from .kernel_dealer import KernelUnavailable
 from .log import StatsMessage, logger, stats_logger
 
 
@@ -57,6 +60,7 @@ class RootHandler(tornado.web.RequestHandler):
         code = None
         lang = self.get_argument("lang", None)
         interacts = None
+        permalink = None
         if "c" in args:
             # The code is explicitly specified
             code = self.get_argument("c")
@@ -89,15 +93,20 @@ class RootHandler(tornado.web.RequestHandler):
                 self.set_status(404)
                 self.finish("ID not found in permalink database")
                 return
+            permalink = q
         if code is not None:
             code = url_escape(code, plus=False)
         if interacts is not None:
             interacts = url_escape(interacts, plus=False)
         autoeval = self.get_argument(
             "autoeval", "false" if code is None else "true" )
+        if autoeval != "true" or self.application.output_cache is None:
+            # Only output of autoevaluated permalinks is recorded
+            permalink = None
         self.render(
             "root.html",
-            code=code, lang=lang, interacts=interacts, autoeval=autoeval)
+            code=code, lang=lang, interacts=interacts, autoeval=autoeval,
+            permalink=permalink)
 
     def options(self):
         self.set_status(200)
@@ -150,12 +159,51 @@ class KernelHandler(tornado.web.RequestHandler):
             ws_url = "%s://%s/" % (proto, host)
             timeout = min(float(self.get_argument("timeout", 0)),
                           config.get("max_timeout"))
-            kernel = await self.application.kernel_dealer.get_kernel(
-                rlimits=config.get("provider_settings")["preforked_rlimits"],
-                lifespan=config.get("max_lifespan"),
-                timeout=timeout)
+            dealer = self.application.kernel_dealer
+            try:
+                profile = dealer.pick_profile(
+                    self.get_argument("profile", None),
+                    self.get_argument("language", None))
+            except ValueError as e:
+                self.set_status(400)
+                self.permissions()
+                self.finish(str(e))
+                return
+            setup = self.get_argument("setup", "") or None
+            if setup is not None and len(setup) > 65000:
+                self.set_status(413)
+                self.permissions()
+                self.finish("Max setup code size is 65000 characters")
+                return
+            # Output of permalinks may be recorded, see OutputCache. Only the
+            # stored code of the permalink is, whatever the client claims.
+            permalink = self.get_argument("permalink", "") or None
+            output_cache = self.application.output_cache
+            if output_cache is None or setup is not None:
+                permalink = None
+            if permalink is not None:
+                try:
+                    code = (await self.application.db.get(permalink))[0]
+                    permalink = (permalink, _code_hash(code), profile)
+                except LookupError:
+                    permalink = None
+            try:
+                if (permalink is not None
+                        and output_cache.get(permalink) is not None):
+                    kernel = dealer.defer_kernel(
+                        profile=profile, timeout=timeout)
+                else:
+                    kernel = await dealer.get_kernel(
+                        profile=profile, timeout=timeout, setup=setup)
+            except KernelUnavailable as e:
+                self.set_status(503)
+                self.set_header("Retry-After", e.retry_after)
+                self.permissions()
+                self.finish()
+                return
             kernel.referer=self.request.headers.get('Referer', '')
             kernel.remote_ip=self.request.remote_ip
+            kernel.permalink = permalink
             data = {"ws_url": ws_url, "id": kernel.id}
             self.set_header("Jupyter-Kernel-ID", kernel.id)
             self.write(self.permissions(data))
@@ -189,17 +237,44 @@ class KernelHandler(tornado.web.RequestHandler):
         return data
 
 
+class InterruptHandler(KernelHandler):
+    """
+    Interrupts the current computation of a kernel, keeping it alive.
+    """
+    
+    def post(self, kernel_id):
+        try:
+            self.application.kernel_dealer.kernel(kernel_id).interrupt()
+        except KeyError:
+            logger.debug("interrupt for non-existing kernel %s", kernel_id)
+            self.set_status(404)
+        self.permissions()
+        self.finish()
+
+
 class Completer(object):
     
     name_pattern = re.compile(r"\b[a-z_]\w*$", re.IGNORECASE)
 
     def __init__(self, kernel_dealer):
         self.waiting = {}
+        self.kernel_dealer = kernel_dealer
+        self.request_kernel()
+
+    def request_kernel(self):
         def cb(task):
-            self.kernel = task.result()
+            try:
+                self.kernel = task.result()
+            except KernelUnavailable as e:
+                logger.warning("no completer kernel, retrying")
+                asyncio.get_running_loop().call_later(
+                    e.retry_after, self.request_kernel)
+                return
             self.kernel.channels["shell"].on_recv(self.on_recv)
             logger.info("completer kernel ready")
-        asyncio.ensure_future(kernel_dealer.get_kernel()).add_done_callback(cb)
+        asyncio.ensure_future(self.kernel_dealer.get_kernel(
+            profile="completer", lifespan=float("inf"), internal=True)
+            ).add_done_callback(cb)
 
     def registerRequest(self, addr, msg):
         content = msg["content"]
@@ -235,6 +310,111 @@ class Completer(object):
         addr.send(b"complete," + jsonapi.dumps(msg, default=misc.sage_json))
 
 
+class HealthChecker(object):
+    r"""
+    Run a trivial computation on a reserved kernel for deep health checks.
+    
+    The kernel is requested for the first check and kept for later ones, a
+    new one is requested if it dies or a check times out.
+    """
+    
+    code = "print(1 + 1)"
+    timeout = 10    # seconds, including the startup of a new kernel
+    
+    def __init__(self, kernel_dealer):
+        self.kernel_dealer = kernel_dealer
+        self.kernel = None
+        self._lock = asyncio.Lock()
+        
+    async def check(self):
+        r"""
+        Run the check, one at a time.
+        
+        OUTPUT:
+        
+        - dictionary with ``success`` and the duration of the check in
+          seconds or the reason of its failure
+        """
+        async with self._lock:
+            start = time.time()
+            try:
+                success = await asyncio.wait_for(
+                    self._execute(), self.timeout)
+            except KernelUnavailable:
+                return {"success": False, "reason": "no kernel available"}
+            except asyncio.TimeoutError:
+                logger.warning("deep health check timed out")
+                if self.kernel is not None and self.kernel.alive:
+                    self.kernel.stop()
+                self.kernel = None
+                return {"success": False, "reason": "timeout"}
+            return {"success": success, "time": time.time() - start}
+            
+    async def _execute(self):
+        dealer = self.kernel_dealer
+        if self.kernel is None or not self.kernel.alive:
+            profile = "health"
+            if profile not in dealer.provider_settings["profiles"]:
+                profile = "default"
+            self.kernel = await dealer.get_kernel(
+                profile=profile, lifespan=float("inf"))
+        zmq_handler = ZMQServiceHandler()
+        zmq_handler.connect(self.kernel)
+        streams = zmq_handler.streams
+        done = asyncio.get_event_loop().create_future()
+        
+        def kernel_callback(msg):
+            if msg['parent_header'].get('msg_id') != zmq_handler.parent_id:
+                return
+            if msg['msg_type'] == 'execute_reply':
+                streams['success'] = msg['content']['status'] == 'ok'
+            if (self.kernel.status == "idle" and 'success' in streams
+                    and not done.done()):
+                done.set_result(None)
+                
+        zmq_handler.msg_from_kernel_callbacks.append(kernel_callback)
+        zmq_handler.send(self.kernel.session.msg("execute_request", {
+            "code": self.code,
+            "silent": False,
+            "user_expressions": {},
+            "allow_stdin": False,
+            }))
+        await done
+        return streams['success'] and streams['stdout'] == "2\n"
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    r"""
+    Report the state of the server to load balancers without using kernels.
+    
+    ``GET /health`` returns the dealer state (see ``KernelDealer.health``)
+    and the current event loop lag in seconds as JSON. The status is 503 if
+    no kernel provider is live. With ``deep=true``, a trivial computation is
+    also run on a reserved kernel (see ``HealthChecker``), and the status is
+    503 if it fails. With ``stats=true``, all collected statistics are added
+    (see ``KernelDealer.metrics``).
+    """
+    
+    async def get(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await asyncio.sleep(0)
+        lag = loop.time() - start
+        health = self.application.kernel_dealer.health()
+        health["loop_lag"] = lag
+        if self.get_argument("stats", "false") == "true":
+            health["stats"] = self.application.kernel_dealer.metrics()
+        healthy = health["live_providers"] > 0
+        if self.get_argument("deep", "false") == "true":
+            health["deep"] = await self.application.health_checker.check()
+            healthy = healthy and health["deep"]["success"]
+        health["status"] = "ok" if healthy else "fail"
+        if not healthy:
+            self.set_status(503)
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(health)
+
+
 class SockJSHandler(sockjs.tornado.SockJSConnection):
 
     def on_open(self, request):
@@ -251,15 +431,20 @@ class SockJSHandler(sockjs.tornado.SockJSConnection):
             if msg_type in ("complete_request", "object_info_request"):
                 app.completer.registerRequest(self, message)
             return
-        try:
-            kernel = app.kernel_dealer.kernel(id)
-        except KeyError:
-            # Ignore messages to nonexistent or killed kernels.
-            logger.warning("%s sent to nonexistent kernel %s", msg_type, id)
-            return
+        channel = self.channels.get(id)
+        if channel is not None and channel.hibernated:
+            kernel = channel.kernel
+        else:
+            try:
+                kernel = app.kernel_dealer.kernel(id)
+            except KeyError:
+                # Ignore messages to nonexistent or killed kernels.
+                logger.warning("%s sent to nonexistent kernel %s",
+                               msg_type, id)
+                return
         if id not in self.channels:
             self.channels[id] = SockJSChannelsHandler(self.send)
-            self.channels[id].connect(kernel)
+            self.channels[id].connect(kernel, app.output_cache)
         if msg_type == "execute_request":
             stats_logger.info(StatsMessage(
                 kernel_id=id,
@@ -319,8 +504,8 @@ class ServiceHandler(tornado.web.RequestHandler):
 
     The code to be executed is given in the code request parameter.
 
-    This handler is currently not production-ready. But it is used for health
-    checks...
+    This handler is currently not production-ready. Each request uses a
+    kernel, so health checks should use ``HealthHandler`` instead.
     """
 
     async def post(self):
@@ -343,10 +528,21 @@ class ServiceHandler(tornado.web.RequestHandler):
             return
         remote_ip = self.request.remote_ip
         referer = self.request.headers.get('Referer', '')
-        self.kernel = await self.application.kernel_dealer.get_kernel(
-            rlimits=config.get("provider_settings")["preforked_rlimits"],
-            lifespan=config.get("max_lifespan"),
-            timeout=0)
+        dealer = self.application.kernel_dealer
+        try:
+            profile = dealer.pick_profile(
+                self.get_argument("profile", "service"))
+        except ValueError as e:
+            self.set_status(400)
+            self.finish(str(e) + '\n')
+            return
+        try:
+            self.kernel = await dealer.get_kernel(profile=profile, timeout=0)
+        except KernelUnavailable as e:
+            self.set_status(503)
+            self.set_header('Retry-After', e.retry_after)
+            self.finish('No kernels available, try again later\n')
+            return
         sm = StatsMessage(
             kernel_id=self.kernel.id,
             remote_ip=remote_ip,
@@ -363,6 +559,8 @@ class ServiceHandler(tornado.web.RequestHandler):
         loop = tornado.ioloop.IOLoop.current()
         
         def kernel_callback(msg):
+            if msg['parent_header'].get('msg_id') != self.zmq_handler.parent_id:
+                return
             if msg['msg_type'] == 'execute_reply':
                 loop.remove_timeout(self.timeout_handle)
                 streams['success'] = msg['content']['status'] == 'ok'
@@ -405,6 +603,85 @@ class ServiceHandler(tornado.web.RequestHandler):
         self.finish(self.zmq_handler.streams)
 
 
+def _code_hash(code):
+    return hashlib.sha1(code.encode("utf-8")).hexdigest()
+
+
+class OutputCache(object):
+    r"""
+    Recorded output of autoevaluated permalinks.
+    
+    The first evaluation of a permalink is recorded by its channels handler,
+    later visitors get a deferred kernel and the recording is replayed to
+    them (see ``ZMQChannelsHandler.replay``). Recordings are keyed by
+    ``(permalink, hash of its stored code, profile)``, so only evaluations
+    of the stored code are recorded, separately for each kernel profile.
+    They are kept for up to
+    ``permalink_output_cache`` permalinks, least recently used first, and
+    expire after ``permalink_output_ttl`` seconds.
+    
+    INPUT:
+    
+    - ``dir`` -- directory with user files saved by kernels, files of
+      recorded evaluations are kept in memory
+    """
+    
+    def __init__(self, dir):
+        self.dir = dir
+        self._recordings = collections.OrderedDict()    # key: recording
+        
+    def get(self, key):
+        r"""
+        Return the recording for ``key`` or ``None``.
+        """
+        recording = self._recordings.get(key)
+        if recording is None:
+            return None
+        if time.time() > recording["expires"]:
+            del self._recordings[key]
+            return None
+        self._recordings.move_to_end(key)
+        return recording
+        
+    def add(self, key, recording, kernel_id):
+        r"""
+        Store ``recording`` of an evaluation in kernel ``kernel_id``.
+        
+        Files saved by the kernel are stored with it. Recordings larger than
+        ``permalink_output_max_size`` are dropped.
+        """
+        max_size = config.get("permalink_output_max_size")
+        size = len(json.dumps(
+            [msg["content"] for msg in recording["messages"]]))
+        files = {}
+        root = os.path.join(self.dir, kernel_id)
+        for top, dirs, names in os.walk(root):
+            for name in names:
+                path = os.path.join(top, name)
+                name = os.path.relpath(path, root)
+                if name == "sagemathcell.py" or size > max_size:
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        files[name] = f.read()
+                except (IOError, OSError) as e:
+                    logger.warning("cannot record %s: %s", path, e)
+                    return
+                size += len(files[name])
+        if size > max_size:
+            logger.info("output of permalink %s is too large to record",
+                        key[0])
+            return
+        recording["files"] = files
+        recording["expires"] = time.time() + config.get("permalink_output_ttl")
+        self._recordings[key] = recording
+        self._recordings.move_to_end(key)
+        while len(self._recordings) > config.get("permalink_output_cache"):
+            self._recordings.popitem(last=False)
+        logger.info("recorded output of permalink %s, %d bytes",
+                    key[0], size)
+
+
 class ZMQChannelsHandler(object):
     """
     This handles the websocket-ZMQ bridge to an IPython kernel.
@@ -412,6 +689,16 @@ class ZMQChannelsHandler(object):
     It also handles the heartbeat (hb) stream that same kernel, but there is no
     associated websocket connection. The websocket is instead used to notify
     the client if the heartbeat stream fails.
+    
+    Executed code and interact states are recorded, so that idle kernels of
+    sessions with interacts can hibernate: the kernel is stopped, and the next
+    message from the client is preceded by replaying the session into a new
+    kernel. Output of the replay is not sent to the client.
+    
+    With an ``OutputCache``, the first evaluation of a permalink is recorded.
+    Sessions of later visitors start hibernated on a deferred kernel: the
+    recording answers their evaluation of the same code, anything else wakes
+    them up as above.
     """
 
     def _json_msg(self, msg):
@@ -423,18 +710,101 @@ class ZMQChannelsHandler(object):
         # sage_json handles things like encoding dates and sage types
         return jsonapi.dumps(msg, default=misc.sage_json)
 
-    def connect(self, kernel):
-        self.kernel = kernel
+    def connect(self, kernel, output_cache=None):
+        self.kernel_id = kernel.id  # known to the client
         self.msg_from_kernel_callbacks = []
         self.msg_to_kernel_callbacks = []
+        self.history = []   # content of execute requests
+        self.interact_ids = []  # in the order of creation
+        self.interact_values = collections.defaultdict(dict)
+        self.hibernated = False
+        self.pending = []   # messages waiting for a new kernel
+        self.replayed = set()   # IDs of replayed messages
+        self.output_cache = output_cache
+        self.permalink = None   # (permalink, hash of stored code, profile)
+        if output_cache is not None:
+            self.permalink = getattr(kernel, "permalink", None)
+        self.recording = None   # output being recorded for the permalink
+        self.recorded = None    # output to replay instead of starting kernel
+        if kernel.channels is None:
+            # Deferred kernel, started only if the recording is not enough
+            self.kernel = kernel
+            kernel.on_stop(self.kernel_stopped)
+            self.hibernated = True
+            if self.permalink is not None:
+                self.recorded = output_cache.get(self.permalink)
+        else:
+            self.attach(kernel)
+
+    def attach(self, kernel):
+        self.kernel = kernel
         for channel in ["iopub", "shell"]:
             kernel.channels[channel].on_recv_stream(self.on_recv)
         kernel.on_stop(self.kernel_stopped)
+        if self.interact_ids:
+            kernel.on_hibernate(self.hibernate)
 
     def disconnect(self):
+        # Hibernated kernels are stopped already, deferred ones are not.
+        if self.kernel.alive:
+            self.kernel.stop()
+        self.kernel.release()
+        self.hibernated = False
+        
+    def hibernate(self):
+        self.hibernated = True
+        self.kernel.on_stop(None)
         self.kernel.stop()
+        
+    async def wake(self):
+        r"""
+        Replay the hibernated session into a new kernel.
+        """
+        old = self.kernel
+        try:
+            if time.time() > old.hard_deadline:
+                raise KernelUnavailable(0)
+            kernel = await old.successor()
+        except KernelUnavailable:
+            logger.warning("cannot restore hibernated kernel %s", old.id)
+            self.hibernated = False
+            self.pending = []
+            old.on_stop(None)
+            if old.alive:
+                old.stop()
+            self.kernel_stopped()
+            return
+        if not self.hibernated:
+            # The client is gone.
+            kernel.stop()
+            kernel.release()
+            return
+        logger.info("restoring hibernated kernel %s into %s", old.id, kernel.id)
+        kernel.referer = getattr(old, "referer", "")
+        kernel.remote_ip = getattr(old, "remote_ip", "")
+        self.hibernated = False
+        self.attach(kernel)
+        session = kernel.session
+        replay = [session.msg(
+            "sagecell.restore", {"interact_ids": self.interact_ids})]
+        replay.extend(session.msg("execute_request", content)
+                      for content in self.history)
+        replay.extend(session.msg("sagenb.interact.update_interact", {
+                "interact_id": interact_id,
+                "values": values,
+                "update_last": True,
+                })
+            for interact_id, values in self.interact_values.items())
+        for msg in replay:
+            self.replayed.add(msg["header"]["msg_id"])
+            self._send(msg)
+        pending, self.pending = self.pending, []
+        for msg in pending:
+            self.send(msg)
 
     def kernel_stopped(self):
+        self.hibernated = False
+        self.kernel.release()
         msg = {
             "channel": "iopub",
             'header': {
@@ -448,12 +818,106 @@ class ZMQChannelsHandler(object):
             'content': {'execution_state': 'dead'}
         }
         self.output_message(msg)
+        
+    def _reparent(self, msg, parent):
+        r"""
+        Return a copy of recorded ``msg`` in reply to ``parent``.
+        """
+        msg = dict(msg, parent_header=parent["header"])
+        msg["header"] = dict(msg["header"], msg_id=str(uuid.uuid4()))
+        msg["msg_id"] = msg["header"]["msg_id"]
+        return msg
+        
+    def record(self, msg):
+        r"""
+        Record output of the first execute request for the output cache.
+        
+        Evaluations that fail are not recorded.
+        """
+        recording = self.recording
+        msg_type = msg["msg_type"]
+        if msg_type == "kernel_info_reply":
+            # Clients ask for it after the execute request, it may come
+            # after the recording is stored.
+            recording["kernel_info"] = dict(msg)
+            recording["kernel_info"].pop("buffers", None)
+            return
+        if (recording["done"]
+                or msg["parent_header"].get("msg_id") != recording["parent"]):
+            return
+        if msg_type == "kernel_timeout":
+            recording["timeout"] = self.kernel.timeout
+            return
+        msg = dict(msg)
+        msg.pop("buffers", None)
+        recording["messages"].append(msg)
+        if msg_type == "execute_reply":
+            if msg["content"]["status"] != "ok":
+                self.recording = None
+                return
+            recording["replied"] = True
+        elif msg_type == "display_data":
+            interact = msg["content"]["data"].get("application/sage-interact")
+            if interact:
+                recording["interact_ids"].append(interact["new_interact_id"])
+        elif (msg_type == "status"
+                and msg["content"]["execution_state"] == "idle"):
+            recording["idle"] = True
+        if recording["replied"] and recording["idle"]:
+            recording["done"] = True
+            self.output_cache.add(self.permalink, recording, self.kernel.id)
+            
+    def replay(self, msg):
+        r"""
+        Answer ``msg`` from recorded output instead of starting a kernel.
+        
+        Only the first execute request with the recorded code and user
+        expressions, and kernel info requests can be answered.
+        
+        OUTPUT:
+        
+        - ``True`` if ``msg`` was answered
+        """
+        recorded = self.recorded
+        if recorded is None or self.kernel.channels is not None:
+            return False
+        msg_type = msg["header"]["msg_type"]
+        if msg_type == "kernel_info_request":
+            if recorded["kernel_info"] is None:
+                return False
+            self.output_message(self._reparent(recorded["kernel_info"], msg))
+            return True
+        if (msg_type != "execute_request" or self.history
+                or msg["content"].get("user_expressions", {})
+                    != recorded["user_expressions"]
+                or _code_hash(msg["content"]["code"]) != recorded["code"]):
+            return False
+        kernel = self.kernel
+        logger.info("replaying recorded output of permalink %s to %s",
+                    self.permalink[0], kernel.id)
+        self.history.append(msg["content"])
+        self.interact_ids.extend(recorded["interact_ids"])
+        if self.interact_ids:
+            kernel.on_hibernate(self.hibernate)
+        for recorded_msg in recorded["messages"]:
+            self.output_message(self._reparent(recorded_msg, msg))
+        kernel.files = recorded["files"]
+        kernel.last_activity = time.time()
+        if recorded["timeout"] is not None:
+            kernel.timeout = recorded["timeout"]
+        if kernel.timeout > 0:
+            kernel.deadline = kernel.last_activity + kernel.timeout
+        else:
+            kernel.stop()
+        return True
 
     def on_recv(self, stream, msg_list):
         kernel = self.kernel
         msg_list = kernel.session.feed_identities(msg_list)[1]
         msg = kernel.session.deserialize(msg_list)
         msg["channel"] = stream.channel
+        kernel.last_activity = time.time()
+        replayed = msg["parent_header"].get("msg_id") in self.replayed
         # Useful but may be way too verbose even for debugging
         #logger.debug("received from kernel %s", msg)
         msg_type = msg["msg_type"]
@@ -462,6 +926,7 @@ class ZMQChannelsHandler(object):
         if msg_type in ("execute_reply",
                         "sagenb.interact.update_interact_reply"):
             kernel.executing -= 1
+            kernel.watch_execution()
             logger.debug("decreased execution counter for %s to %s",
                          kernel.id, kernel.executing)
         if msg_type == "kernel_timeout":
@@ -469,10 +934,17 @@ class ZMQChannelsHandler(object):
             logger.debug("reset timeout for %s to %f", kernel.id, timeout)
             if timeout >= 0:
                 kernel.timeout = min(timeout, config.get("max_timeout"))
-        else:
+        elif not replayed:
             for callback in self.msg_from_kernel_callbacks:
                 callback(msg)
             self.output_message(msg)
+        if self.recording is not None:
+            self.record(msg)
+        if msg_type == "display_data":
+            interact = msg["content"]["data"].get("application/sage-interact")
+            if interact and interact["new_interact_id"] not in self.interact_ids:
+                self.interact_ids.append(interact["new_interact_id"])
+                kernel.on_hibernate(self.hibernate)
         if kernel.timeout > 0:
             kernel.deadline = time.time() + kernel.timeout
         elif kernel.executing == 0 and kernel.status == "idle":
@@ -480,6 +952,42 @@ class ZMQChannelsHandler(object):
             kernel.stop()
 
     def send(self, msg):
+        if self.hibernated and not self.pending and self.replay(msg):
+            return
+        if self.hibernated:
+            self.pending.append(msg)
+            if len(self.pending) == 1:
+                asyncio.ensure_future(self.wake())
+            return
+        msg_type = msg['header']['msg_type']
+        if msg_type == 'execute_request':
+            code = _code_hash(msg['content']['code'])
+            # Record only the stored code of the permalink. Clients ask for
+            # new files in user expressions, the reply is recorded too.
+            user_expressions = msg['content'].get('user_expressions', {})
+            if (self.permalink is not None and not self.history
+                    and code == self.permalink[1]
+                    and set(user_expressions) <= {"_sagecell_files"}
+                    and self.output_cache.get(self.permalink) is None):
+                self.recording = {
+                    "parent": msg['header']['msg_id'],
+                    "code": code,
+                    "user_expressions": user_expressions,
+                    "messages": [],
+                    "interact_ids": [],
+                    "timeout": None,
+                    "kernel_info": None,
+                    "replied": False,
+                    "idle": False,
+                    "done": False,
+                    }
+            self.history.append(msg['content'])
+        elif msg_type == 'sagenb.interact.update_interact':
+            self.interact_values[msg['content']['interact_id']].update(
+                msg['content']['values'])
+        self._send(msg)
+        
+    def _send(self, msg):
         # Useful but may be way too verbose even for debugging
         #logger.debug("sending to kernel %s", msg)
         for f in self.msg_to_kernel_callbacks:
@@ -488,18 +996,32 @@ class ZMQChannelsHandler(object):
         if msg['header']['msg_type'] in ('execute_request',
                                          'sagenb.interact.update_interact'):
             kernel.executing += 1
+            kernel.watch_execution()
             logger.debug("increased execution counter for %s to %s",
                 kernel.id, kernel.executing)
         kernel.session.send(kernel.channels["shell"], msg)
 
 
 class ZMQServiceHandler(ZMQChannelsHandler):
+    r"""
+    Collect output of a single execute request.
+    
+    Service kernels may be reused for many requests, so only messages
+    caused by this request are collected.
+    """
     
     def __init__(self):
         super(ZMQServiceHandler, self).__init__()
         self.streams = collections.defaultdict(str)
+        self.parent_id = None
+
+    def send(self, msg):
+        self.parent_id = msg['header']['msg_id']
+        super(ZMQServiceHandler, self).send(msg)
 
     def output_message(self, msg):
+        if msg["parent_header"].get("msg_id") != self.parent_id:
+            return
         if msg["channel"] == "iopub" and msg["header"]["msg_type"] == "stream":
             self.streams[msg["content"]["name"]] += msg["content"]["text"]
 
@@ -511,7 +1033,7 @@ class SockJSChannelsHandler(ZMQChannelsHandler):
 
     def output_message(self, msg):
         self.callback(
-            "%s/channels,%s" % (self.kernel.id, self._json_msg(msg).decode()))
+            "%s/channels,%s" % (self.kernel_id, self._json_msg(msg).decode()))
 
 
 class WebChannelsHandler(ZMQChannelsHandler,
@@ -524,7 +1046,8 @@ class WebChannelsHandler(ZMQChannelsHandler,
         self.send(jsonapi.loads(msg))
 
     def open(self, kernel_id):
-        self.connect(self.application.kernel_dealer.kernel(kernel_id))
+        self.connect(self.application.kernel_dealer.kernel(kernel_id),
+                     self.application.output_cache)
 
     def output_message(self, msg):
         self.write_message(self._json_msg(msg))
@@ -554,6 +1077,22 @@ class FileHandler(StaticHandler):
         return None
         
     async def get(self, kernel_id, file_path):
+        try:
+            kernel = self.application.kernel_dealer.kernel(kernel_id)
+        except KeyError:
+            kernel = None
+        files = getattr(kernel, "files", {})
+        if file_path in files:
+            # Recorded output replayed by a deferred kernel
+            self.set_extra_headers(file_path)
+            self.set_header("Content-Type",
+                mimetypes.guess_type(file_path)[0]
+                or "application/octet-stream")
+            self.finish(files[file_path])
+            return
+        if kernel is not None:
+            # Restored hibernated kernels save files under their own ID.
+            kernel_id = kernel.id
         await super(FileHandler, self).get('%s/%s'%(kernel_id, file_path))
 
     def set_extra_headers(self, path):
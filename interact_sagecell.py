@@ -396,7 +396,8 @@ def interact(f, controls=None, update=None, layout=None, locations=None,
     if output and "_output" not in placed:
         layout.append([("_output", 1)])
 
-    interact_id = str(uuid.uuid4())
+    ids = sys._sage_.interact_ids
+    interact_id = ids.popleft() if ids else str(uuid.uuid4())
     msgs = {n: c.message() for n, c in controls.items()}
     for n, m in msgs.items():
         if controls[n].label is not None:
@@ -301,10 +301,14 @@ function init(cellInfo, k) {
             language,
             cellInfo.interacts || [],
             k,
-            cellInfo.linked || false
+            cellInfo.linked || false,
+            cellInfo.setupCode || "",
+            cellInfo.permalinkId || ""
         );
         cellInfo.session = session;
         cellInfo.interacts = [];
+        // Only the first evaluation of a permalink may use recorded output
+        cellInfo.permalinkId = "";
         session.execute(code);
         last_session[evt.data.id] = session;
         output.find(".sagecell_output_elements").show();
@@ -28,7 +28,15 @@ var close = null;
 
 var jmolCounter = 0;
 
-export function Session(outputDiv, language, interact_vals, k, linked) {
+export function Session(
+    outputDiv,
+    language,
+    interact_vals,
+    k,
+    linked,
+    setup,
+    permalink
+) {
     this.timer = utils.simpleTimer();
     this.outputDiv = outputDiv;
     this.outputDiv[0].sagecell_session = this;
@@ -117,6 +125,12 @@ export function Session(outputDiv, language, interact_vals, k, linked) {
             CellSessionID: utils.cellSessionID(),
             timeout: linked ? "inf" : 0,
             accepted_tos: "true",
+            // Linked cells share the kernel and may use different languages
+            language: linked ? "" : language,
+            // Cacheable setup code is run by the server before the kernel starts
+            setup: setup,
+            // The server may replay recorded output of the permalink
+            permalink: permalink,
         });
     }
     var pl_button, pl_box, pl_zlink, pl_qlink, pl_qrcode, pl_chkbox;
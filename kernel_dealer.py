@@ -1,5 +1,11 @@
 import asyncio
+import bisect
+import collections
+import copy
+import hashlib
+import math
 import time
+import uuid
 
 import jupyter_client.session
 import tornado.ioloop
@@ -12,6 +18,126 @@ from .import misc
 config = misc.Config()
 
 
+class KernelUnavailable(Exception):
+    r"""
+    Raised when a kernel request cannot be served in reasonable time.
+    
+    ``retry_after`` is the suggested delay in seconds before trying again.
+    """
+    
+    def __init__(self, retry_after):
+        super(KernelUnavailable, self).__init__(
+            "no kernels available, retry after %d s" % retry_after)
+        self.retry_after = retry_after
+
+
+class KernelRequest(object):
+    r"""
+    Request for a kernel from the dealer point of view.
+    
+    Kernels of the same profile are interchangeable, so requests and kernels
+    delivered by providers are matched by the profile name, used as the
+    request class. Kernels prepared with cacheable setup code are matched by
+    ``"<profile>:<hash of setup code>"`` instead.
+    """
+    
+    def __init__(self, profile, setup=None):
+        self.profile = profile
+        self.setup = setup
+        self.cls = profile
+        if setup is not None:
+            self.cls += ":" + hashlib.sha1(setup.encode()).hexdigest()
+        self.future = asyncio.get_running_loop().create_future()
+        self.time = time.time()
+        self.queue = None   # RequestQueue currently holding this request
+        self.provider = None    # ProviderConnection it was sent to
+        self.sent = None
+        self.original = None    # for hedges
+        self.hedges = []
+        
+    def hedge(self):
+        r"""
+        Return a duplicate of this request sharing its future.
+        """
+        twin = copy.copy(self)
+        twin.queue = None
+        twin.original = self
+        twin.hedges = []
+        self.hedges.append(twin)
+        return twin
+
+
+class RequestQueue(object):
+    r"""
+    FIFO queues of kernel requests, one per kernel class.
+    
+    All operations take constant (amortized) time. Requests are taken out in
+    the order of arrival, either within a given class or across all classes.
+    Discarded requests are left in place and skipped when they reach the front.
+    """
+    
+    def __init__(self):
+        self._queues = {}   # class: deque of KernelRequest
+        self._depth = collections.Counter() # class: number of requests
+        self._length = 0
+        
+    def __len__(self):
+        return self._length
+        
+    def depth(self, cls):
+        return self._depth[cls]
+        
+    def _head(self, cls):
+        queue = self._queues[cls]
+        while queue and queue[0].queue is not self:
+            queue.popleft()
+        if not queue:
+            del self._queues[cls]
+            return None
+        return queue[0]
+        
+    def push(self, request, front=False):
+        queue = self._queues.setdefault(request.cls, collections.deque())
+        if front:
+            queue.appendleft(request)
+        else:
+            queue.append(request)
+        request.queue = self
+        self._depth[request.cls] += 1
+        self._length += 1
+        
+    def pop(self, cls=None):
+        r"""
+        Remove and return the oldest request of the given class.
+        
+        If ``cls`` is ``None``, the oldest request of any class is returned.
+        Returns ``None`` if there are no suitable requests.
+        """
+        if cls is None:
+            heads = [self._head(c) for c in list(self._queues)]
+            heads = [r for r in heads if r is not None]
+            if not heads:
+                return None
+            request = min(heads, key=lambda r: r.time)
+        elif cls in self._queues:
+            request = self._head(cls)
+            if request is None:
+                return None
+        else:
+            return None
+        self._queues[request.cls].popleft()
+        self.discard(request)
+        return request
+        
+    def discard(self, request):
+        if request.queue is self:
+            request.queue = None
+            self._depth[request.cls] -= 1
+            if not self._depth[request.cls]:
+                del self._depth[request.cls]
+            self._length -= 1
+
+
 class KernelConnection(object):
     """
     Kernel from the dealer point of view.
@@ -21,6 +147,7 @@ class KernelConnection(object):
     
     def __init__(self, dealer, id, connection, lifespan, timeout):
         self._on_stop = None
+        self._on_hibernate = None
         self._dealer = dealer
         self.id = id
         self.executing = 0
@@ -45,53 +172,144 @@ class KernelConnection(object):
             stream.channel = channel
             self.channels[channel] = stream
         self.channels["iopub"].socket.subscribe(b"")
+        self.last_activity = now
+        self._execution_timer = None
+        self._watched_executing = 0
+        self.reusable = False   # can be reset and returned to the pool
+        self.uses = 0   # how many times the kernel was reset and reused
+        self.setup = None   # cacheable setup code it was prepared with
         self.start_hb()
         logger.debug("KernelConnection initialized")
         
     def on_stop(self, callback):
         self._on_stop = callback
         
+    def on_hibernate(self, callback):
+        r"""
+        Call ``callback`` instead of idling longer than ``hibernate_after``.
+        
+        The callback is expected to record what is needed to restore the
+        session and to stop this kernel.
+        """
+        self._on_hibernate = callback
+        
     def start_hb(self):
         logger.debug("start_hb for %s", self.id)
-        hb = self.channels["hb"]
-        ioloop = tornado.ioloop.IOLoop.current()
 
         def pong(message):
             #logger.debug("pong for %s", self.id)
             self._expecting_pong = False
 
-        hb.on_recv(pong)
+        self.channels["hb"].on_recv(pong)
         self._expecting_pong = False
-
-        def ping():
-            #logger.debug("ping for %s", self.id)
-            now = ioloop.time()
-            if self._expecting_pong:
+        self._beat_interval = config.get("beat_interval")
+        self._timer = self._dealer.timers.add(
+            config.get("first_beat"), self._check)
+        self.alive = True
+        
+    def _check(self):
+        r"""
+        Check deadlines and liveness of this kernel, called by the dealer.
+        
+        Kernels with recent shell/iopub traffic are not pinged, quiet ones are
+        pinged with exponentially increasing intervals.
+        """
+        #logger.debug("check for %s", self.id)
+        now = time.time()
+        beat_interval = config.get("beat_interval")
+        if now > self.hard_deadline:
+            logger.info("hard deadline reached for %s", self.id)
+            self.stop()
+            return
+        if (self.timeout > 0
+                and now > self.deadline
+                and self.status == "idle"):
+            logger.info("kernel %s timed out", self.id)
+            self.stop()
+            return
+        hibernate_after = config.get("hibernate_after")
+        if (self._on_hibernate is not None
+                and hibernate_after is not None
+                and now - self.last_activity > hibernate_after
+                and self.status == "idle"
+                and self.executing == 0):
+            logger.info("kernel %s is hibernating", self.id)
+            self._on_hibernate()
+            return
+        if self._expecting_pong:
+            if now - max(self._ping_time, self.last_activity) \
+                    >= self._beat_interval:
                 logger.warning("kernel %s died unexpectedly", self.id)
+                self.status = "dead"
                 self.stop()
-            elif now > self.hard_deadline:
-                logger.info("hard deadline reached for %s", self.id)
-                self.stop()
-            elif (self.timeout > 0
-                    and now > self.deadline
-                    and self.status == "idle"):
-                logger.info("kernel %s timed out", self.id)
-                self.stop()
-            else:
-                hb.send(b'ping')
-                self._expecting_pong = True
-
-        self._hb_periodic_callback = tornado.ioloop.PeriodicCallback(
-            ping, config.get("beat_interval") * 1000)
-
-        def start_ping():
-            logger.debug("start_ping for %s", self.id)
-            if self.alive:
-                self._hb_periodic_callback.start()
+                return
+        elif now - self.last_activity < beat_interval:
+            self._beat_interval = beat_interval
+        else:
+            #logger.debug("ping for %s", self.id)
+            self.channels["hb"].send(b'ping')
+            self._expecting_pong = True
+            self._ping_time = now
+            self._beat_interval = min(
+                2 * self._beat_interval, config.get("max_beat_interval"))
+        delay = min(self._beat_interval, self.hard_deadline - now)
+        if self.timeout > 0:
+            delay = min(delay, max(self.deadline - now, beat_interval))
+        self._timer = self._dealer.timers.add(delay, self._check)
 
-        self._start_ping_handle = ioloop.call_later(
-            config.get("first_beat"), start_ping)
-        self.alive = True
+    async def successor(self):
+        r"""
+        Return a new kernel to take over the session of this one.
+        
+        It has the same profile, setup code, and idle timeout, and the
+        remaining lifespan of this kernel. The dealer gives it out for the ID
+        of this kernel too.
+        """
+        kernel = await self._dealer.get_kernel(
+            self.profile,
+            lifespan=max(self.hard_deadline - time.time(), 0),
+            timeout=self.timeout,
+            setup=self.setup)
+        self._dealer.forward(self.id, kernel.id)
+        return kernel
+        
+    def release(self):
+        r"""
+        Stop giving out this kernel for the IDs of kernels it succeeded.
+        """
+        self._dealer.forget_aliases(self.id)
+        
+    def interrupt(self):
+        r"""
+        Interrupt the current computation, the kernel stays alive.
+        """
+        logger.info("interrupting kernel %s", self.id)
+        self._dealer.interrupt_kernel(self.id)
+        
+    def watch_execution(self):
+        r"""
+        Start the wall-clock budget when an execution starts or ends.
+        
+        Queued executions run one after another, so each one gets
+        ``max_execution_time`` seconds from the end of the previous one.
+        Queueing more executions does not extend the running one.
+        """
+        started = self.executing > self._watched_executing
+        self._watched_executing = self.executing
+        if started and self._execution_timer is not None:
+            return
+        if self._execution_timer is not None:
+            self._dealer.timers.cancel(self._execution_timer)
+            self._execution_timer = None
+        budget = config.get("max_execution_time")
+        if self.executing > 0 and budget and self.alive:
+            self._execution_timer = self._dealer.timers.add(
+                budget, self._execution_expired)
+            
+    def _execution_expired(self):
+        self._execution_timer = None
+        logger.info("kernel %s exceeded execution time", self.id)
+        self.interrupt()
 
     def stop(self):
         logger.debug("stopping kernel %s", self.id)
@@ -99,20 +317,315 @@ class KernelConnection(object):
             logger.warning("not alive already")
             return
         self.stop_hb()
+        if self._execution_timer is not None:
+            self._dealer.timers.cancel(self._execution_timer)
+            self._execution_timer = None
         if self._on_stop:
             self._on_stop()
+        if self.reusable and self.status == "idle" and self.executing == 0:
+            self._reset()
+            return
         for stream in self.channels.values():
             stream.close()
         self._dealer.stop_kernel(self.id)
         
+    def _reset(self):
+        r"""
+        Ask the kernel to clean up after its user and return it for reuse.
+        
+        The kernel is stopped if it does not confirm the reset within
+        ``reset_timeout`` seconds.
+        """
+        logger.debug("resetting kernel %s", self.id)
+        settings = self._dealer.provider_settings["profiles"][self.profile]
+        cpu_limit = settings["rlimits"].get("RLIMIT_CPU")
+        
+        def finish(msg_list=None):
+            if msg_list is not None:
+                msg = self.session.deserialize(
+                    self.session.feed_identities(msg_list)[1])
+                if msg["msg_type"] != "sagecell.reset_reply":
+                    return
+            self._dealer.timers.cancel(timer)
+            if msg_list is None or msg["content"]["status"] != "ok":
+                logger.warning("kernel %s was not reset", self.id)
+            elif cpu_limit and msg["content"]["result"].get(
+                    "cpu_left", cpu_limit) < cpu_limit:
+                logger.debug("kernel %s has used up its CPU time", self.id)
+            else:
+                self.uses += 1
+                if self._dealer.keep_kernel(self, msg["content"]["result"]):
+                    return
+                for stream in self.channels.values():
+                    stream.close()
+                self._dealer.return_kernel(self.id, reset=True)
+                return
+            for stream in self.channels.values():
+                stream.close()
+            self._dealer.stop_kernel(self.id)
+                
+        self.channels["iopub"].on_recv(None)
+        self.channels["shell"].on_recv(finish)
+        timer = self._dealer.timers.add(config.get("reset_timeout"), finish)
+        self.session.send(self.channels["shell"], "sagecell.reset",
+                          {"cpu_limit": cpu_limit})
+        
+    def keep(self):
+        r"""
+        Stay connected to this reset kernel while it waits for a new user.
+        
+        Output left over from the previous user is discarded. Kernels that
+        are not dealt again within ``max_timeout`` seconds are stopped.
+        """
+        logger.debug("keeping kernel %s", self.id)
+        self._on_stop = None
+        self._on_hibernate = None
+        for stream in self.channels.values():
+            stream.on_recv(lambda msg_list: None)
+        self.reusable = False
+        self.executing = 0
+        self._watched_executing = 0
+        self.status = "idle"
+        self.timeout = 0
+        self.hard_deadline = time.time() + config.get("max_timeout")
+        self.start_hb()
+        
+    def renew(self, lifespan, timeout):
+        r"""
+        Prepare a kept kernel for a new user, as if it was just connected.
+        """
+        now = time.time()
+        self.hard_deadline = now + lifespan
+        self.timeout = timeout
+        if timeout > 0:
+            self.deadline = now + timeout
+        self.last_activity = now
+        
     def stop_hb(self):
         logger.debug("stop_hb for %s", self.id)
         self.alive = False
-        self._hb_periodic_callback.stop()
-        tornado.ioloop.IOLoop.current().remove_timeout(self._start_ping_handle)
+        self._dealer.timers.cancel(self._timer)
         self.channels["hb"].on_recv(None)
 
 
+class DeferredKernel(object):
+    r"""
+    Kernel that is dealt without being started.
+    
+    Some sessions can be served without a kernel for a while, e.g. from
+    recorded output. Once a real kernel is needed, ``successor`` starts one
+    and the dealer gives it out for the ID of the deferred kernel too.
+    Deferred kernels expire like real ones after their lifespan or idle
+    timeout, except that sessions which could hibernate are not timed out.
+    """
+    
+    channels = None
+    
+    def __init__(self, dealer, profile, lifespan, timeout):
+        self._on_stop = None
+        self._on_hibernate = None
+        self._dealer = dealer
+        self.id = str(uuid.uuid4())
+        self.profile = profile
+        self.executing = 0
+        self.status = "idle"
+        now = time.time()
+        self.hard_deadline = now + lifespan
+        self.timeout = timeout
+        if timeout > 0:
+            self.deadline = now + self.timeout
+        self.last_activity = now
+        self.reusable = False
+        self.setup = None
+        self.files = {}  # path: contents, served instead of saved files
+        self.alive = True
+        self._timer = dealer.timers.add(
+            config.get("max_beat_interval"), self._check)
+        
+    def on_stop(self, callback):
+        self._on_stop = callback
+        
+    def on_hibernate(self, callback):
+        self._on_hibernate = callback
+        
+    def _check(self):
+        now = time.time()
+        if (now > self.hard_deadline
+                or self.timeout > 0 and now > self.deadline
+                    and self._on_hibernate is None):
+            logger.info("deferred kernel %s expired", self.id)
+            self.stop()
+            return
+        self._timer = self._dealer.timers.add(
+            config.get("max_beat_interval"), self._check)
+        
+    async def successor(self):
+        r"""
+        Return a real kernel to take over the session of this one.
+        
+        See ``KernelConnection.successor``.
+        """
+        kernel = await self._dealer.get_kernel(
+            self.profile,
+            lifespan=max(self.hard_deadline - time.time(), 0),
+            timeout=self.timeout,
+            setup=self.setup)
+        self._on_stop = None
+        self.stop()
+        self._dealer.forward(self.id, kernel.id)
+        return kernel
+        
+    def release(self):
+        self._dealer.forget_aliases(self.id)
+        
+    def interrupt(self):
+        pass
+        
+    def stop(self):
+        logger.debug("stopping deferred kernel %s", self.id)
+        if not self.alive:
+            return
+        self.alive = False
+        self._dealer.timers.cancel(self._timer)
+        if self._on_stop:
+            self._on_stop()
+        self._dealer.stop_kernel(self.id)
+
+
+class TimerWheel(object):
+    r"""
+    Hashed timer wheel driving many coarse timers with one periodic callback.
+    
+    Timers are rounded up to whole ticks and fire at most one tick late.
+    Adding and cancelling a timer takes constant time.
+    """
+    
+    def __init__(self, tick, size=512):
+        self.tick = tick
+        self._slots = [[] for _ in range(size)]
+        self._current = 0
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(
+            self._advance, tick * 1000)
+        self._periodic_callback.start()
+        
+    def add(self, delay, callback):
+        r"""
+        Call ``callback`` after ``delay`` seconds, return a handle for it.
+        """
+        ticks = max(1, math.ceil(delay / self.tick))
+        size = len(self._slots)
+        timer = [(ticks - 1) // size, callback]   # remaining rounds, callback
+        self._slots[(self._current + ticks) % size].append(timer)
+        return timer
+        
+    def cancel(self, timer):
+        timer[1] = None
+        
+    def _advance(self):
+        self._current = (self._current + 1) % len(self._slots)
+        due = []
+        pending = []
+        for timer in self._slots[self._current]:
+            if timer[1] is None:
+                continue
+            if timer[0]:
+                timer[0] -= 1
+                pending.append(timer)
+            else:
+                due.append(timer[1])
+        self._slots[self._current] = pending
+        for callback in due:
+            try:
+                callback()
+            except Exception:
+                logger.exception("timer callback failed")
+                
+    def stop(self):
+        self._periodic_callback.stop()
+
+
+class Histogram(object):
+    r"""
+    Distribution of durations in buckets growing by a factor of two.
+    """
+    
+    bounds = [0.001 * 2**k for k in range(17)] # in seconds, up to about 1 min
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        
+    def summary(self):
+        r"""
+        Return a JSON-friendly dictionary describing the distribution.
+        
+        Buckets are labeled by their upper bounds in milliseconds, empty
+        buckets are omitted.
+        """
+        labels = ["{:g}".format(b * 1000) for b in self.bounds] + ["inf"]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": {label: n
+                        for label, n in zip(labels, self.counts) if n},
+            }
+
+
+class ProviderConnection(object):
+    r"""
+    Kernel provider from the dealer point of view.
+    
+    Keeps the last load report of a provider and the get requests sent to it
+    since then. Reports include the number of get requests received by the
+    provider, so that the credits it advertised can be adjusted for requests
+    still on the way. Reports are also sent periodically as heartbeats.
+    """
+    
+    def __init__(self, addr):
+        self.addr = addr
+        self.last_seen = time.time()
+        self.load = None
+        self.requests = RequestQueue()  # waiting for kernels from provider
+        self.sent = 0   # get requests sent to this provider
+        self.unacknowledged = collections.deque()  # (number, class)
+        
+    def credits(self, cls=None):
+        r"""
+        Return how many kernels can be requested from this provider now.
+        
+        If ``cls`` is given, count only preforked kernels of this class.
+        """
+        if self.load is None:
+            return 0
+        if cls is None:
+            return self.load["capacity"] - len(self.unacknowledged)
+        return self.load["preforked"].get(cls, 0) - sum(
+            1 for _, c in self.unacknowledged if c == cls)
+        
+    def report(self, load):
+        load["preforked"] = dict(load["preforked"])
+        self.load = load
+        while (self.unacknowledged
+               and self.unacknowledged[0][0] < load["received"]):
+            self.unacknowledged.popleft()
+            
+    def request(self, cls):
+        r"""
+        Account for a get request of class ``cls`` sent to this provider.
+        """
+        self.unacknowledged.append((self.sent, cls))
+        self.sent += 1
+
+
 class KernelDealer(object):
     r"""
     Kernel Dealer handles compute kernels on the server side.
@@ -120,12 +633,26 @@ class KernelDealer(object):
     
     def __init__(self, provider_settings):
         self.provider_settings = provider_settings
-        self._available_providers = []
-        self._connected_providers = {}  # provider address: last message time
-        self._expected_kernels = []
-        self._get_queue = []
+        self._providers = {}    # provider address: ProviderConnection
+        self._get_queue = RequestQueue()    # waiting for providers
         self._kernel_origins = {}   # id: provider address
         self._kernels = {}  # id: KernelConnection
+        self._aliases = {}  # id of a hibernated kernel: id of its successor
+        self._kept = collections.defaultdict(list)  # profile: reset kernels
+        self.stats = collections.defaultdict(lambda: {
+            "requested": 0, "served": 0, "rejected": 0, "kept": 0,
+            "deferred": 0,
+            "total_wait": 0.0, "max_wait": 0.0})
+        self.provider_stats = {"connected": 0, "evicted": 0, "rerouted": 0}
+        self.hedge_stats = {"hedged": 0, "won": 0, "returned": 0}
+        self._latencies = collections.deque(maxlen=200) # from get to kernel
+        self._last_delivery = time.time()
+        self._delivery_interval = 1.0   # moving average in seconds
+        # Kernel startup phase: Histogram of durations
+        self.startup_stats = collections.defaultdict(Histogram)
+        # Heartbeats and deadlines of all kernels
+        self.timers = TimerWheel(config.get("beat_interval"))
+        self.timers.add(config.get("provider_timeout"), self._check_providers)
         context = zmq.Context.instance()
         context.IPV6 = 1
         socket = context.socket(zmq.ROUTER)
@@ -137,58 +664,514 @@ class KernelDealer(object):
         
     def _try_to_get(self):
         r"""
-        Send a get request if possible AND needed.
+        Send get requests if possible AND needed.
+        
+        Requests are distributed according to provider credits and sent in
+        one batch per provider.
         """
-        while self._available_providers and self._get_queue:
-            self._stream.send(self._available_providers.pop(0), zmq.SNDMORE)
-            self._stream.send_json(["get", self._get_queue.pop(0)])
-            logger.debug("sent get request to a provider")
-        if self._available_providers:
-            logger.debug("%s available providers are idling",
-                len(self._available_providers))
+        batches = collections.defaultdict(list)
+        setups = collections.defaultdict(dict)
+        hedging = (config.get("hedge_percentile") is not None
+                   and len(self._providers) > 1)
+        while self._get_queue:
+            providers = [p for p in self._providers.values()
+                         if p.credits() > 0]
+            if not providers:
+                break
+            request = self._get_queue.pop()
+            if request.future.done():
+                continue    # Served by a hedge already.
+            provider = self._pick_provider(providers, request.cls)
+            self._send_to(provider, request)
+            batches[provider].append(request.cls)
+            if request.setup is not None:
+                setups[provider][request.cls] = request.setup
+            if hedging and request.original is None:
+                self.timers.add(self._hedge_delay(),
+                                lambda request=request: self._hedge(request))
+        for provider, batch in batches.items():
+            self._stream.send(provider.addr, zmq.SNDMORE)
+            self._stream.send_json(["get", batch, setups[provider]])
+            logger.debug("sent %d get requests to a provider", len(batch))
         if self._get_queue:
             logger.debug("%s get requests are waiting for providers",
                 len(self._get_queue))
+            
+    def _send_to(self, provider, request):
+        r"""
+        Account for ``request`` to be sent to ``provider``.
+        """
+        provider.request(request.cls)
+        provider.requests.push(request)
+        request.provider = provider
+        request.sent = time.time()
+        
+    def _cancel(self, request):
+        r"""
+        Withdraw ``request`` from its queue, and from its provider if sent.
+        
+        Providers would otherwise keep forking, e.g. waiting for a zygote,
+        for requests nobody waits for anymore.
+        """
+        provider = request.provider
+        if (provider is not None and request.queue is provider.requests
+                and self._providers.get(provider.addr) is provider):
+            self._stream.send(provider.addr, zmq.SNDMORE)
+            self._stream.send_json(["cancel", request.cls])
+        request.queue.discard(request)
+        
+    def _hedge_delay(self):
+        r"""
+        Return how long to wait for a kernel before hedging a request.
+        
+        This is the ``hedge_percentile`` of recent kernel allocation
+        latencies, but at least ``hedge_min_delay``.
+        """
+        delay = config.get("hedge_min_delay")
+        if self._latencies:
+            latencies = sorted(self._latencies)
+            i = int(len(latencies) * config.get("hedge_percentile") / 100)
+            delay = max(delay, latencies[min(i, len(latencies) - 1)])
+        return delay
+        
+    def _hedge(self, request):
+        r"""
+        Send a duplicate of a slow request to another provider.
+        
+        Whichever kernel arrives first is used, the other one is returned to
+        its provider.
+        """
+        if (request.future.done()
+                or request.provider is None
+                or request.queue is not request.provider.requests):
+            return
+        providers = [p for p in self._providers.values()
+                     if p is not request.provider and p.credits() > 0]
+        if not providers:
+            return
+        provider = self._pick_provider(providers, request.cls)
+        twin = request.hedge()
+        self._send_to(provider, twin)
+        self._stream.send(provider.addr, zmq.SNDMORE)
+        setups = {} if twin.setup is None else {twin.cls: twin.setup}
+        self._stream.send_json(["get", [twin.cls], setups])
+        self.hedge_stats["hedged"] += 1
+        logger.debug("hedged a request after %.3fs", time.time() - request.sent)
+        
+    def _pick_provider(self, providers, cls):
+        r"""
+        Return the least loaded of the given providers.
+        
+        Providers having a preforked kernel of class ``cls`` are preferred.
+        """
+        
+        def score(provider):
+            load = provider.load
+            return (provider.credits(cls) <= 0,
+                    load["kernels"] + len(provider.unacknowledged),
+                    load["load"], -load["free_memory"])
+            
+        return min(providers, key=score)
+        
+    def _check_providers(self):
+        r"""
+        Evict providers that have been silent for too long.
+        
+        Providers that have not sent a load report yet are still starting,
+        e.g. loading Sage and warming up, and are not checked.
+        """
+        timeout = config.get("provider_timeout")
+        now = time.time()
+        for provider in list(self._providers.values()):
+            if provider.load is not None and now - provider.last_seen > timeout:
+                self._evict(provider)
+        self._try_to_get()
+        self.timers.add(timeout / 4, self._check_providers)
+        
+    def _evict(self, provider):
+        r"""
+        Forget a provider, re-route its requests, and stop its kernels.
+        """
+        logger.warning("provider %r is silent for %.1fs, evicting",
+            provider.addr, time.time() - provider.last_seen)
+        del self._providers[provider.addr]
+        self.provider_stats["evicted"] += 1
+        rerouted = []
+        while provider.requests:
+            request = provider.requests.pop()
+            if not request.future.done() and request.original is None:
+                rerouted.append(request)
+        for request in reversed(rerouted):
+            self._get_queue.push(request, front=True)
+        self.provider_stats["rerouted"] += len(rerouted)
+        for id, addr in list(self._kernel_origins.items()):
+            if addr == provider.addr:
+                kernel = self._kernels.get(id) or self._find_kept(id)
+                if kernel is not None:
+                    logger.warning("kernel %s is lost with its provider", id)
+                    kernel.status = "dead"
+                    kernel.reusable = False
+                    kernel.stop()
+                else:
+                    self._kernel_origins.pop(id)
         
     def _recv(self, msg):
         logger.debug("received %s", msg)
         assert len(msg) == 2
         addr = msg[0]
-        self._connected_providers[addr] = time.time()
+        provider = self._providers.get(addr)
+        if provider is None:
+            provider = self._providers[addr] = ProviderConnection(addr)
+            self.provider_stats["connected"] += 1
+        provider.last_seen = time.time()
         msg = zmq.utils.jsonapi.loads(msg[1])
         if msg == "get settings":
             self._stream.send(addr, zmq.SNDMORE)
             self._stream.send_json(["settings", self.provider_settings])
-        elif msg == "ready":
-            self._available_providers.append(addr)
+        elif msg[0] == "ready":
+            provider.report(msg[1])
             self._try_to_get()
+        elif msg[0] == "died":
+            id, status, rusage = msg[1:]
+            logger.info("kernel %s died: %s, CPU time used %s",
+                        id, status["reason"], rusage)
+            kernel = self._kernels.get(id) or self._find_kept(id)
+            if kernel is not None:
+                kernel.status = "dead"
+                kernel.reusable = False
+                kernel.stop()
+        elif msg[0] == "failed":
+            # The provider could not start kernels for these requests.
+            cls, n = msg[1:]
+            logger.warning("provider %r failed %d requests of class %s",
+                           addr, n, cls)
+            for _ in range(n):
+                request = provider.requests.pop(cls)
+                while request is not None and request.future.done():
+                    request = provider.requests.pop(cls)
+                if request is None:
+                    break
+                original = request.original or request
+                if all(r.queue is None for r in [original] + original.hedges):
+                    original.future.set_exception(
+                        KernelUnavailable(self.retry_after()))
         elif msg[0] == "kernel":
             msg = msg[1]
-            for i, (rlimits, f) in enumerate(self._expected_kernels):
-                if rlimits == msg["rlimits"]:
-                    self._kernel_origins[msg["id"]] = addr
-                    self._expected_kernels.pop(i)
-                    f.set_result(msg)
-                    break
+            self._kernel_origins[msg["id"]] = addr
+            request = self._claim(provider, msg["profile"])
+            if request is None:
+                logger.debug("returning unclaimed kernel %s", msg["id"])
+                self.return_kernel(msg["id"])
+                self.hedge_stats["returned"] += 1
+            else:
+                self._latencies.append(time.time() - request.sent)
+                if request.original is not None:
+                    self.hedge_stats["won"] += 1
+                request.future.set_result(msg)
+                
+    def _claim(self, provider, cls):
+        r"""
+        Return the oldest request of class ``cls`` still waiting for a kernel.
+        
+        Requests sent to ``provider`` are preferred. If the request for which
+        a kernel was started has been abandoned or served by a hedge, the
+        kernel can go to another one.
+        """
+        for queue in (provider.requests, self._get_queue):
+            request = queue.pop(cls)
+            while request is not None and request.future.done():
+                request = queue.pop(cls)
+            if request is not None:
+                if request.sent is None:
+                    request.sent = time.time()
+                return request
+        return None
+            
+    def pick_profile(self, name=None, language=None):
+        r"""
+        Return the name of the kernel profile to use for a request.
+        
+        INPUT:
+        
+        - ``name`` - explicitly requested profile name
+        
+        - ``language`` - language of the cell, used if ``name`` is not given
+        
+        OUTPUT:
+        
+        - the requested profile, the first one for ``language``, or
+          ``"default"``
+        
+        Raise ``ValueError`` for unknown profile names and for profiles that
+        are internal to the server (``"public": False``).
+        """
+        profiles = self.provider_settings["profiles"]
+        if name:
+            if not profiles.get(name, {}).get("public", True):
+                raise ValueError("kernel profile %r is internal" % name)
+            if name not in profiles:
+                raise ValueError("unknown kernel profile %r" % name)
+            return name
+        for name, settings in profiles.items():
+            if (language and settings.get("language") == language
+                    and settings.get("public", True)):
+                return name
+        return "default"
             
-    async def get_kernel(self,
-            rlimits={}, lifespan=float("inf"), timeout=float("inf")):
-        f = asyncio.get_running_loop().create_future()
-        self._expected_kernels.append((rlimits, f))
-        self._get_queue.append(rlimits)
+    async def get_kernel(self, profile="default",
+            lifespan=None, timeout=float("inf"), setup=None, internal=False):
+        r"""
+        Return a new kernel.
+        
+        INPUT:
+        
+        - ``profile`` - name of the kernel profile
+        
+        - ``lifespan`` - maximal lifespan in seconds, by default the one of
+          the profile or ``max_lifespan``
+        
+        - ``timeout`` - allowed idling in seconds
+        
+        - ``setup`` - cacheable setup code, if given the kernel is forked
+          from a zygote that has run this code already
+        
+        - ``internal`` - if ``True``, the request is made by the server itself
+          and is exempt from ``max_queue_depth`` and ``max_queue_wait``
+        
+        Kernels kept connected after a reset (see ``keep_kernel``) are dealt
+        first, without asking providers.
+        
+        Raise ``KernelUnavailable`` if too many requests are waiting already
+        or this one was not served within ``max_queue_wait`` seconds.
+        """
+        settings = self.provider_settings["profiles"][profile]
+        if lifespan is None:
+            lifespan = settings.get("lifespan", config.get("max_lifespan"))
+        request = KernelRequest(profile, setup)
+        stats = self.stats[profile]
+        stats["requested"] += 1
+        kept = self._kept[profile] if setup is None else []
+        while kept and not kept[-1].alive:
+            logger.warning("dropping dead kept kernel %s", kept[-1].id)
+            self.stop_kernel(kept[-1].id)
+        if kept:
+            kernel = kept.pop()
+            kernel.renew(lifespan, timeout)
+            kernel.reusable = kernel.uses < settings.get("max_reuse", 0)
+            stats["served"] += 1
+            stats["kept"] += 1
+            self._kernels[kernel.id] = kernel
+            logger.info("dealing kept kernel %s", kernel.id)
+            return kernel
+        if (not internal
+                and self.queue_depth() >= config.get("max_queue_depth")):
+            stats["rejected"] += 1
+            logger.warning("kernel queue is full, rejecting request")
+            raise KernelUnavailable(self.retry_after())
+        self._get_queue.push(request)
         self._try_to_get()
-        d = await f
+        try:
+            d = await asyncio.wait_for(
+                request.future,
+                None if internal else config.get("max_queue_wait"))
+        except asyncio.TimeoutError:
+            stats["rejected"] += 1
+            logger.warning("kernel request timed out in the queue")
+            raise KernelUnavailable(self.retry_after())
+        except KernelUnavailable:
+            stats["rejected"] += 1
+            logger.warning("kernel request failed")
+            raise
+        finally:
+            for r in [request] + request.hedges:
+                if r.queue is not None:
+                    self._cancel(r)
+        timings = d.pop("timings", {})
+        timings["queue_wait"] = self._record_wait(request)
         d.pop("rlimits")
+        d.pop("profile")
+        uses = d.pop("uses", 0)
         d["lifespan"] = lifespan
         d["timeout"] = timeout
+        start = time.time()
         kernel = KernelConnection(self, **d)
+        timings["connection"] = time.time() - start
+        kernel.profile = profile
+        kernel.setup = setup
+        kernel.uses = uses
+        # Prepared kernels are not clean enough for others.
+        kernel.reusable = (setup is None
+                           and uses < settings.get("max_reuse", 0))
+        for phase, duration in timings.items():
+            self.startup_stats[phase].add(duration)
+        logger.debug("kernel %s startup timings %s", kernel.id, timings)
         self._kernels[kernel.id] = kernel
         logger.debug("tracking %d kernels", len(self._kernels))
         logger.info("dealing kernel %s", kernel.id)
         return kernel
         
+    def defer_kernel(self, profile="default",
+            lifespan=None, timeout=float("inf")):
+        r"""
+        Return a ``DeferredKernel``, a real one is started only if needed.
+        
+        INPUT:
+        
+        - ``profile``, ``lifespan``, ``timeout`` - as for ``get_kernel``
+        """
+        if lifespan is None:
+            lifespan = self.provider_settings["profiles"][profile].get(
+                "lifespan", config.get("max_lifespan"))
+        kernel = DeferredKernel(self, profile, lifespan, timeout)
+        self.stats[profile]["deferred"] += 1
+        self._kernels[kernel.id] = kernel
+        logger.info("dealing deferred kernel %s", kernel.id)
+        return kernel
+        
+    def _record_wait(self, request):
+        now = time.time()
+        self._delivery_interval = (0.9 * self._delivery_interval
+                                   + 0.1 * (now - self._last_delivery))
+        self._last_delivery = now
+        wait = now - request.time
+        stats = self.stats[request.profile]
+        stats["served"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        logger.debug("kernel of class %s delivered after %.3fs",
+            request.cls, wait)
+        return wait
+        
     def kernel(self, id):
-        return self._kernels[id]
+        return self._kernels[self._aliases.get(id, id)]
+        
+    def forward(self, old_id, new_id):
+        r"""
+        Make kernel ``new_id`` available as ``old_id`` as well.
+        
+        Clients of a restored hibernated kernel keep using its old ID.
+        """
+        for alias, id in self._aliases.items():
+            if id == old_id:
+                self._aliases[alias] = new_id
+        self._aliases[old_id] = new_id
+        
+    def forget_aliases(self, id):
+        r"""
+        Stop giving out kernel ``id`` for the IDs of kernels it succeeded.
+        
+        Aliases outlive hibernation, so they are forgotten only once the
+        session is over.
+        """
+        for alias in [a for a, i in self._aliases.items() if i == id]:
+            del self._aliases[alias]
+        
+    def queue_depth(self):
+        r"""
+        Return the number of kernel requests waiting to be served.
+        """
+        return len(self._get_queue) + sum(
+            len(p.requests) for p in self._providers.values())
+        
+    def health(self):
+        r"""
+        Return a summary of the dealer state for health checks.
+        
+        OUTPUT:
+        
+        - dictionary with the numbers of connected providers and of live ones
+          (that have reported within ``provider_timeout`` seconds), preforked
+          kernels of live providers for each profile, the number of kernels
+          that can be requested from them (capacity), the queue depth, and the
+          numbers of dealt and kept kernels
+        """
+        now = time.time()
+        timeout = config.get("provider_timeout")
+        live = [p for p in self._providers.values()
+                if p.load is not None and now - p.last_seen <= timeout]
+        preforked = collections.Counter()
+        for provider in live:
+            preforked.update(provider.load["preforked"])
+        return {
+            "providers": len(self._providers),
+            "live_providers": len(live),
+            "preforked": dict(preforked),
+            "capacity": sum(max(p.credits(), 0) for p in live),
+            "queue_depth": self.queue_depth(),
+            "kernels": len(self._kernels),
+            "kept": sum(map(len, self._kept.values())),
+            }
+        
+    def capacity_weight(self):
+        r"""
+        Return the share of kernel capacity that is free, in percent.
+        
+        The capacity of live providers is reduced by the requests not sent
+        to any of them yet and compared to ``max_kernels`` of each provider.
+        Requests sent to providers are accounted for in their credits
+        already. Return ``None`` if no provider is live.
+        """
+        health = self.health()
+        if not health["live_providers"]:
+            return None
+        total = (health["live_providers"]
+                 * self.provider_settings["max_kernels"])
+        free = health["capacity"] - len(self._get_queue)
+        return int(100 * min(max(free / total, 0), 1))
+        
+    def retry_after(self):
+        r"""
+        Estimate in how many seconds a new kernel request may be served.
+        """
+        estimate = (self.queue_depth() + 1) * self._delivery_interval
+        return max(1, math.ceil(min(estimate, config.get("max_queue_wait"))))
+        
+    def queue_stats(self):
+        r"""
+        Return queue depth and wait time statistics for each kernel profile.
+        """
+        result = {}
+        for cls, stats in self.stats.items():
+            stats = dict(stats)
+            stats["queued"] = self._get_queue.depth(cls)
+            stats["expected"] = sum(
+                p.requests.depth(cls) for p in self._providers.values())
+            stats["mean_wait"] = (stats["total_wait"] / stats["served"]
+                                  if stats["served"] else 0.0)
+            result[cls] = stats
+        return result
+        
+    def startup_timings(self):
+        r"""
+        Return distributions of the time spent in each kernel startup phase.
+        
+        Phases measured by providers (``fork``, ``directory``,
+        ``app_initialize``, ``kernel_initialize``, ``rlimits``, ``connect``,
+        ``ready_send``, and ``pool`` for the time spent preforked) are followed
+        by ``queue_wait`` for the whole wait of a request and ``connection``
+        for connecting to the kernel.
+        """
+        return {phase: histogram.summary()
+                for phase, histogram in self.startup_stats.items()}
+        
+    def metrics(self):
+        r"""
+        Return all statistics collected by the dealer and its providers.
+        
+        OUTPUT:
+        
+        - dictionary with ``queue_stats``, ``startup_timings``, provider and
+          hedging counters, and the last load report of each provider
+          (including its own counters and memory usage) by address
+        """
+        return {
+            "queues": self.queue_stats(),
+            "startup": self.startup_timings(),
+            "providers": dict(self.provider_stats),
+            "hedges": dict(self.hedge_stats),
+            "provider_reports": {
+                addr.hex(): p.load for addr, p in self._providers.items()},
+            }
         
     def stop(self):
         r"""
@@ -196,15 +1179,87 @@ class KernelDealer(object):
         """
         self._stream.stop_on_recv()
         for k in list(self._kernels.values()):
+            k.reusable = False
             k.stop()
-        for addr in self._connected_providers:
+        for kept in list(self._kept.values()):
+            for k in list(kept):
+                k.stop()
+        self.timers.stop()
+        for addr in self._providers:
             logger.debug("stopping %r", addr)
             self._stream.send(addr, zmq.SNDMORE)
             self._stream.send_json("disconnect")
         self._stream.flush()
 
+    def return_kernel(self, id, reset=False):
+        r"""
+        Give a kernel that is not needed anymore back to its provider.
+        
+        ``reset`` kernels have been used and cleaned up since.
+        """
+        addr = self._kernel_origins.pop(id, None)
+        kernel = self._kernels.pop(id, None)
+        if addr is None:
+            return
+        self._stream.send(addr, zmq.SNDMORE)
+        if reset:
+            self._stream.send_json(["reuse", id, kernel.uses])
+        else:
+            self._stream.send_json(["return", id])
+        
+    def keep_kernel(self, kernel, usage):
+        r"""
+        Keep a reset kernel connected to deal it again without the provider.
+        
+        INPUT:
+        
+        - ``kernel`` - ``KernelConnection`` that has just been reset
+        
+        - ``usage`` - resource usage reported by the reset, ``max_rss`` is
+          the peak memory usage of the kernel in bytes
+        
+        OUTPUT:
+        
+        - ``True`` if the kernel is kept, ``False`` if it should be returned
+          to its provider (the profile keeps enough kernels already, the
+          kernel cannot be reused anymore or uses too much memory)
+        """
+        settings = self.provider_settings["profiles"][kernel.profile]
+        kept = self._kept[kernel.profile]
+        if (len(kept) >= settings.get("keep_connected", 0)
+                or kernel.uses >= settings.get("max_reuse", 0)
+                or usage.get("max_rss", 0)
+                    > settings.get("max_rss", float("inf"))):
+            return False
+        self._kernels.pop(kernel.id, None)
+        kernel.keep()
+        kept.append(kernel)
+        return True
+
+    def _find_kept(self, id):
+        r"""
+        Return the kept kernel with the given ID or ``None``.
+        """
+        for kept in self._kept.values():
+            for kernel in kept:
+                if kernel.id == id:
+                    return kernel
+        return None
+
+    def interrupt_kernel(self, id):
+        addr = self._kernel_origins.get(id)
+        if addr is None:
+            return
+        self._stream.send(addr, zmq.SNDMORE)
+        self._stream.send_json(["interrupt", id])
+
     def stop_kernel(self, id):
-        addr = self._kernel_origins.pop(id)
+        if self._kernels.pop(id, None) is None:
+            kernel = self._find_kept(id)
+            if kernel is not None:
+                self._kept[kernel.profile].remove(kernel)
+        addr = self._kernel_origins.pop(id, None)
+        if addr is None:
+            return
         self._stream.send(addr, zmq.SNDMORE)
         self._stream.send_json(["stop", id])
-        self._kernels.pop(id)
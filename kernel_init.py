@@ -1,12 +1,34 @@
 import codecs
+import collections
+import importlib
+import math
+import os
+import resource
+import shutil
 import sys
 import time
 
 import ipykernel.jsonutil
 
+from . import log
 from . import misc
 
 
+# Modules imported by forked kernels in ``initialize``
+KERNEL_MODULES = [
+    "IPython.core.oinspect",
+    "ipykernel.ipkernel",
+    "sage.misc.sagedoc",
+    "sage.repl.ipython_extension",
+    "sage.repl.rich_output",
+    "backend_cell",
+    "interact_sagecell",
+    "interact_compatibility",
+    "dynamic",
+    "exercise",
+    ]
+
+
 def threejs(p, **kwds):
     from warnings import warn
     warn("""
@@ -19,7 +41,36 @@ and will be completely removed in future versions""",
     p.show(**kwds)
     
 
-def initialize(kernel):
+def preload():
+    r"""
+    Prepare everything that does not depend on a particular kernel.
+    
+    This is called by the kernel provider before forking, so that kernels
+    share these modules with it and ``initialize`` has less work to do.
+    """
+    for name in KERNEL_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            log.provider_logger.warning("cannot preload %s: %s", name, e)
+    try:
+        from sage.repl.rich_output import get_display_manager
+        get_display_manager()
+    except ImportError:
+        pass
+    
+
+def initialize(kernel, sage=True):
+    r"""
+    Set up a freshly started kernel for SageMathCell.
+    
+    INPUT:
+    
+    - ``kernel`` - IPython kernel
+    
+    - ``sage`` - whether to load Sage, plain Python kernels cannot use
+      interacts and other Sage-based features
+    """
     
     def new_files(root="./"):
         import os
@@ -61,6 +112,8 @@ def initialize(kernel):
     _sage_.javascript = misc.javascript
     _sage_.new_files = new_files
     _sage_.sent_files = {}
+    # IDs for new interacts, used when a hibernated session is replayed
+    _sage_.interact_ids = collections.deque()
     _sage_.threejs = threejs
     
 
@@ -138,9 +191,11 @@ def initialize(kernel):
             
     _sage_.send_message = send_message
 
-    # Enable Sage types to be sent via session messages
-    from zmq.utils import jsonapi
-    kernel.session.pack = lambda x: jsonapi.dumps(x, default=misc.sage_json)
+    if sage:
+        # Enable Sage types to be sent via session messages
+        from zmq.utils import jsonapi
+        kernel.session.pack = lambda x: jsonapi.dumps(
+            x, default=misc.sage_json)
 
     sys._sage_ = _sage_
     user_ns = kernel.shell.user_module.__dict__
@@ -154,6 +209,98 @@ def initialize(kernel):
             "text/plain": "Clear display"
         })
     sys._sage_.clear = clear
+    if sage:
+        initialize_sage(kernel, user_ns)
+    
+    # In order to show the correct code line when a (deprecation) warning
+    # is triggered, we change the main module name and save user code to
+    # a file with the same name.
+    sys.argv = ['sagemathcell.py']
+    old_execute = kernel.do_execute
+    
+    def new_execute(code, *args, **kwds):
+        with codecs.open('sagemathcell.py', 'w', encoding='utf-8') as f:
+            f.write(code)
+        return old_execute(code, *args, **kwds)
+        
+    kernel.do_execute = new_execute
+    
+    initial_ns = dict(user_ns)
+    home = os.getcwd()
+    
+    def reset(stream, ident, parent):
+        r"""
+        Make the kernel look freshly started, so that it can be reused.
+        
+        ``cpu_limit`` in the request is the CPU time (seconds) each user gets.
+        RLIMIT_CPU counts the time of all users, so its soft limit is raised
+        to give the next one a full budget, as far as the hard limit allows.
+        
+        Return the peak memory usage of the kernel, the CPU time used so far,
+        and, if limited, how much is left for the next user.
+        """
+        kernel.shell.reset()
+        for name, value in initial_ns.items():
+            user_ns.setdefault(name, value)
+        sys._sage_.sent_files.clear()
+        sys._sage_.interact_ids.clear()
+        interacts = sys.modules.get("interact_sagecell")
+        if interacts is not None:
+            vars(interacts)["__interacts"].clear()
+        pyplot = sys.modules.get("matplotlib.pyplot")
+        if pyplot is not None:
+            pyplot.close("all")
+        os.chdir(home)
+        for name in os.listdir(home):
+            path = os.path.join(home, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_time = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux
+        result = {"max_rss": usage.ru_maxrss * 1024, "cpu_time": cpu_time}
+        cpu_limit = parent["content"].get("cpu_limit")
+        if cpu_limit:
+            soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = math.ceil(cpu_time) + cpu_limit
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+            result["cpu_left"] = soft - cpu_time
+        return result
+        
+    register_handler("sagecell.reset", reset)
+    
+    def restore(stream, ident, parent):
+        r"""
+        Prepare replaying a hibernated session into this kernel.
+        
+        Interacts created by the replay get the IDs they had originally, so
+        that the client can keep using them.
+        """
+        sys._sage_.interact_ids.extend(parent["content"]["interact_ids"])
+        
+    register_handler("sagecell.restore", restore)
+
+
+def run_with_first_execution(kernel, setup):
+    r"""
+    Run ``setup`` before the code of the first execute request in ``kernel``.
+    
+    Its output and errors go to the client like those of the user code.
+    """
+    old_execute = kernel.do_execute
+    
+    def new_execute(code, *args, **kwds):
+        kernel.do_execute = old_execute
+        return old_execute(setup + "\n" + code, *args, **kwds)
+        
+    kernel.do_execute = new_execute
+
+
+def initialize_sage(kernel, user_ns):
     kernel.shell.extension_manager.load_extension('sage.repl.ipython_extension')
     import sage
     user_ns["sage"] = sage
@@ -183,17 +330,4 @@ get_display_manager().switch_backend(BackendCell(), shell=get_ipython())
     user_ns.update(exercise.imports)
     user_ns['threejs'] = sys._sage_.threejs
     sys._sage_.update_interact = interact_sagecell.update_interact
-    
-    # In order to show the correct code line when a (deprecation) warning
-    # is triggered, we change the main module name and save user code to
-    # a file with the same name.
-    sys.argv = ['sagemathcell.py']
-    old_execute = kernel.do_execute
-    
-    def new_execute(code, *args, **kwds):
-        with codecs.open('sagemathcell.py', 'w', encoding='utf-8') as f:
-            f.write(code)
-        return old_execute(code, *args, **kwds)
-        
-    kernel.do_execute = new_execute
 
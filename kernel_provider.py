@@ -6,8 +6,15 @@ Kernel Provider starts compute kernels and sends connection info to Dealer.
 
 
 import argparse
+import asyncio
+import collections
 import errno
-from multiprocessing import Process
+import gc
+import math
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.forkserver
+import multiprocessing.reduction
 import os
 import resource
 import signal
@@ -16,32 +23,60 @@ import time
 import uuid
 
 from ipykernel.kernelapp import IPKernelApp
+import psutil
 import zmq
+import zmq.asyncio
 
 from . import kernel_init
 from . import log
 logger = log.provider_logger.getChild(str(os.getpid()))
 
 
-class KernelProcess(Process):
+class KernelProcess(multiprocessing.get_context("fork").Process):
     """
     Kernel from the provider point of view.
     
     Configures a kernel process and does its best at cleaning up.
+    Kernels are always forked to inherit modules loaded by the provider.
     """
     
-    def __init__(self, id, rlimits, dir, waiter_port):
+    def __init__(self, id, profile, settings, dir, waiter_port):
         super(KernelProcess, self).__init__()
         self.id = id
-        self.rlimits = rlimits
+        self.profile = profile
+        self.rlimits = settings["rlimits"]
+        self.warmup = settings.get("warmup", [])
+        self.sage = settings.get("sage", True)
+        self.uses = 0   # how many times the kernel was reset and reused
+        self.max_reuse = settings.get("max_reuse", 0)
+        # Kernels that the provider does not wait for are watched via a
+        # pidfd, their CPU times are sampled while they run.
+        self.pidfd = None
+        self.cpu_times = None
+        self.prepared = {}  # names defined by the setup code of a zygote
+        self.setup = None   # setup code that the zygote failed to run
         self.dir = dir
         self.waiter_port = waiter_port
 
     def run(self):
+        phase_start = time.time()
+        timings = {"fork": phase_start - self.start_time}
+
+        def end_phase(phase):
+            nonlocal phase_start
+            now = time.time()
+            timings[phase] = now - phase_start
+            phase_start = now
+
         global logger
         logger = log.kernel_logger.getChild(str(os.getpid()))
         logger.debug("forked kernel is running")
         log.std_redirect(logger)
+        # Forget the event loop and signal handlers of the provider.
+        asyncio._set_running_loop(None)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
         # Become a group leader for cleaner exit.
         os.setpgrp()
         dir = os.path.join(self.dir, self.id)
@@ -51,6 +86,7 @@ class KernelProcess(Process):
             if e.errno != errno.EEXIST:
                 raise
         os.chdir(dir)
+        end_phase("directory")
         #config = traitlets.config.loader.Config({"ip": self.ip})
         #config.HistoryManager.enabled = False
         app = IPKernelApp.instance(log=logger)
@@ -61,13 +97,33 @@ class KernelProcess(Process):
         # This function should be called via atexit, but it isn't, perhaps due
         # to forking. Stale connection files do cause problems.
         app.cleanup_connection_file()
-        kernel_init.initialize(app.kernel)
+        end_phase("app_initialize")
+        kernel_init.initialize(app.kernel, self.sage)
+        app.kernel.shell.user_ns.update(self.prepared)
+        if self.setup is not None:
+            # Let the user see what is wrong with it.
+            kernel_init.run_with_first_execution(app.kernel, self.setup)
+        end_phase("kernel_initialize")
+        # Pay first-use costs that cannot be paid before forking.
+        for code in self.warmup:
+            try:
+                exec(code, app.kernel.shell.user_ns.copy())
+            except Exception:
+                logger.exception("warm-up exception in %r", code)
+        end_phase("warmup")
         for r, limit in self.rlimits.items():
-            resource.setrlimit(getattr(resource, r), (limit, limit))
+            hard = limit
+            if r == "RLIMIT_CPU":
+                # Each reset gives the next user a budget of their own by
+                # raising the soft limit, see kernel_init.
+                hard = limit * (self.max_reuse + 1)
+            resource.setrlimit(getattr(resource, r), (limit, hard))
+        end_phase("rlimits")
         logger.debug("kernel ready")
         context = zmq.Context.instance()
         socket = context.socket(zmq.PUSH)
         socket.connect("tcp://localhost:{}".format(self.waiter_port))
+        end_phase("connect")
         socket.send_json({
             "id": self.id,
             "connection": {
@@ -77,7 +133,10 @@ class KernelProcess(Process):
                 "iopub": app.iopub_port,
                 "shell": app.shell_port,
                 },
+            "profile": self.profile,
             "rlimits": self.rlimits,
+            "timings": timings,
+            "sent": time.time(),    # the provider will add ready_send
             })
             
         def signal_handler(signum, frame):
@@ -90,11 +149,225 @@ class KernelProcess(Process):
         logger.debug("Kernel.run finished")
 
 
+class PythonKernelProcess(KernelProcess):
+    """
+    Kernel that does not use Sage.
+    
+    It is forked by a server process that has never imported Sage, so the
+    kernel is much smaller and starts faster.
+    """
+    
+    _Popen = staticmethod(
+        multiprocessing.get_context("forkserver").Process._Popen)
+    
+    def start(self):
+        super(PythonKernelProcess, self).start()
+        # The forkserver waits for this process.
+        self.pidfd = open_pidfd(self.pid)
+
+
+class PreparedZygote(multiprocessing.get_context("fork").Process):
+    """
+    Process that has run cacheable setup code and forks kernels from itself.
+    
+    Kernels forked by a zygote find the names defined by the setup code in
+    their namespace without running it again. Like the forkserver of
+    multiprocessing, the zygote gets a pipe with each request and writes to
+    it the PID and then the exit status of the new kernel.
+    """
+    
+    def __init__(self, cls, code, settings):
+        super(PreparedZygote, self).__init__()
+        self.cls = cls
+        self.code = code
+        self.rlimits = settings["rlimits"]
+        self.sage = settings.get("sage", True)
+        self.daemon = True
+        self.connection, self._connection = multiprocessing.Pipe()
+        self.ready = False
+        self.waiting = 0    # requests to serve once the zygote is ready
+        self.forked = 0     # kernels forked so far
+        
+    def run(self):
+        global logger
+        logger = log.provider_logger.getChild(str(os.getpid()))
+        asyncio._set_running_loop(None)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.connection.close()
+        # Limit only the setup code, the zygote keeps forking kernels long
+        # after it and they set their own limits. The provider enforces the
+        # CPU time limit too, see check_cpu_times.
+        limits = {}
+        for r, limit in self.rlimits.items():
+            r = getattr(resource, r)
+            limits[r] = resource.getrlimit(r)
+            hard = limits[r][1]
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(r, (limit, hard))
+        start = time.time()
+        namespace = {}
+        initial = {}
+        setup = None    # for kernels to run if it fails here
+        try:
+            code = self.code
+            if self.sage:
+                # The namespace of kernels, see setup_sage
+                exec("from sage.all__sagemath_symbolics import *", namespace)
+                from sage.repl.preparse import preparse_file
+                code = preparse_file(code)
+            initial = dict(namespace)
+            exec(code, namespace)
+        except Exception:
+            logger.exception("setup code of %s failed", self.cls)
+            setup = self.code
+            namespace = initial = {}
+        prepared = {name: value for name, value in namespace.items()
+                    if initial.get(name, self) is not value
+                    and name != "__builtins__"}
+        for r, limit in limits.items():
+            resource.setrlimit(r, limit)
+        logger.info("prepared %d names for %s in %.3fs",
+                    len(prepared), self.cls, time.time() - start)
+        # Wake up when kernels exit to report their status.
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self._connection.send("ready")
+        children = {}   # PID: pipe for the exit status
+        accepting = True
+        while accepting or children:
+            ready = multiprocessing.connection.wait(
+                [self._connection, wakeup_r] if accepting else [wakeup_r])
+            if wakeup_r in ready:
+                os.read(wakeup_r, 4096)
+            if self._connection in ready:
+                try:
+                    args = self._connection.recv()
+                    status_w = multiprocessing.reduction.recv_handle(
+                        self._connection)
+                except EOFError:
+                    # Dropped by the provider, exit with the last kernel.
+                    accepting = False
+                else:
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.set_wakeup_fd(-1)
+                        for fd in [wakeup_r, wakeup_w, status_w] \
+                                + list(children.values()):
+                            os.close(fd)
+                        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                        self._run_kernel(args, prepared, setup)
+                    multiprocessing.forkserver.write_signed(status_w, pid)
+                    children[pid] = status_w
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                status_w = children.pop(pid)
+                multiprocessing.forkserver.write_signed(
+                    status_w, os.waitstatus_to_exitcode(status))
+                os.close(status_w)
+                
+    def _run_kernel(self, args, prepared, setup):
+        r"""
+        Run a kernel in a process forked by the zygote, never return.
+        
+        ``setup`` is the setup code if it has failed in the zygote, the
+        kernel runs it with the first execution instead.
+        """
+        exitcode = 1
+        try:
+            *args, start_time = args
+            kernel = KernelProcess(*args)
+            kernel.start_time = start_time
+            kernel.prepared = prepared
+            kernel.setup = setup
+            self._connection.close()
+            kernel.run()
+            exitcode = 0
+        except SystemExit as e:
+            exitcode = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("kernel forked by zygote failed")
+        finally:
+            os._exit(exitcode)
+
+
+class PythonPreparedZygote(PreparedZygote):
+    """
+    Prepared zygote for kernels that do not use Sage.
+    """
+    
+    _Popen = staticmethod(
+        multiprocessing.get_context("forkserver").Process._Popen)
+
+
+class PreparedKernel(object):
+    """
+    Kernel forked by a prepared zygote, from the provider point of view.
+    
+    Provides what the provider uses of ``KernelProcess``. The zygote writes
+    the PID and exit status of the kernel to a pipe, but the kernel is
+    watched via its pidfd if possible: it may outlive the zygote.
+    """
+    
+    def __init__(self, zygote, id, profile, settings, dir, waiter_port):
+        self.zygote = zygote
+        self.id = id
+        self.profile = profile
+        self.rlimits = settings["rlimits"]
+        self.uses = 0
+        self.exitcode = None
+        self.pidfd = None
+        self.cpu_times = None
+        # The kernel introduces itself to the dealer with the request class.
+        self._args = (id, zygote.cls, settings, dir, waiter_port)
+        
+    def start(self):
+        r"""
+        Ask the zygote to fork the kernel.
+        
+        Raise ``OSError`` or ``EOFError`` if the zygote is gone.
+        """
+        self._status, status_w = os.pipe()
+        try:
+            try:
+                connection = self.zygote.connection
+                connection.send(self._args + (self.start_time,))
+                multiprocessing.reduction.send_handle(
+                    connection, status_w, self.zygote.pid)
+            finally:
+                os.close(status_w)
+            self.pid = multiprocessing.forkserver.read_signed(self._status)
+        except BaseException:
+            os.close(self._status)
+            raise
+        # The zygote waits for this process.
+        self.pidfd = open_pidfd(self.pid)
+        self.sentinel = self._status if self.pidfd is None else self.pidfd
+        
+    def join(self):
+        # The zygote reports the exit status as soon as it waits for the
+        # kernel, unless it is gone. Then the exit status is unknown.
+        if multiprocessing.connection.wait([self._status], 1):
+            try:
+                self.exitcode = multiprocessing.forkserver.read_signed(
+                    self._status)
+            except (OSError, EOFError):
+                pass
+        os.close(self._status)
+
+
 class KernelProvider(object):
     r"""
     Kernel Provider handles compute kernels on the worker side.
     """
     
+    cpu_sample_interval = 0.5  # seconds, see check_cpu_times, check_zygotes
+    
     def __init__(self, dealer_address, dir):
         self.is_active = False
         self.dir = dir
@@ -117,137 +390,750 @@ class KernelProvider(object):
         reply = self.dealer.recv_json()
         logger.debug("received %s", reply)
         assert reply[0] == "settings"
-        self.preforked_rlimits = reply[1].pop("preforked_rlimits")
+        self.profiles = reply[1].pop("profiles")
+        if not all(p.get("sage", True) for p in self.profiles.values()):
+            # Start the server for plain Python kernels before loading Sage.
+            multiprocessing.set_forkserver_preload([__name__])
+            multiprocessing.forkserver.ensure_running()
         self.max_kernels = reply[1].pop("max_kernels")
-        self.max_preforked = reply[1].pop("max_preforked")
+        self.prefork_window = reply[1].pop("prefork_window")
+        self.max_forking = reply[1].pop("max_forking") or os.cpu_count()
+        zygote = reply[1].pop("zygote")
+        warmup = reply[1].pop("warmup")
+        self.freeze_heap = reply[1].pop("freeze_heap")
+        self.memory_interval = reply[1].pop("memory_report_interval")
+        self.report_interval = reply[1].pop("report_interval")
+        self.max_prepared = reply[1].pop("max_prepared")
+        self.setup_timeout = reply[1].pop("setup_timeout")
         self.waiter = context.socket(zmq.PULL)
         self.waiter_port = self.waiter.bind_to_random_port("tcp://*")
         self.kernels = dict()   # id: KernelProcess
-        self.forking = None
-        self.preforking = None
-        self.preforked = []
-        self.ready_sent = False
-        self.to_kill = []
+        self.forking = set()    # IDs of requested kernels being started
+        # Pools for each profile
+        self.preforking = {}    # IDs of future preforked kernels, oldest first
+        self.preforked = {}
+        # Moving estimates for the preforked pool size
+        self.request_rate = {}  # per second
+        self.request_time = {}
+        self.fork_latency = {}
+        for profile in self.profiles:
+            self.preforking[profile] = []
+            self.preforked[profile] = []
+            self.request_rate[profile] = 0.0
+            self.request_time[profile] = time.time()
+            self.fork_latency[profile] = None
+        self.stats = {"pool_hits": 0, "prefork_takeovers": 0, "cold_forks": 0,
+                      "prepared_forks": 0}
+        self.requests = collections.deque()  # profiles of requested kernels
+        # Request class: PreparedZygote, least recently used first
+        self.zygotes = collections.OrderedDict()
+        self.received = 0   # get requests received from the dealer
+        self.reported = None
+        self.report_time = 0
+        self.to_kill = dict()   # KernelProcess: SIGKILL timer handle
+        self.memory = None
         setup_sage()
+        if zygote:
+            kernel_init.preload()
+        warm_up(warmup)
+        if self.freeze_heap:
+            # Keep the cyclic GC in kernels away from the objects they inherit,
+            # so that their pages stay shared with the provider. Freeze only
+            # once, garbage created later by the provider must stay
+            # collectable.
+            gc.collect()
+            gc.freeze()
 
-    def fork(self, rlimits):
+    def fork(self, profile, zygote=None):
         r"""
         Start a new kernel by forking.
         
         INPUT:
         
-        - ``rlimits`` - dictionary with keys ``resource.RLIMIT_*``
+        - ``profile`` - name of the kernel profile
+        
+        - ``zygote`` - ``PreparedZygote`` to fork the kernel from instead of
+          the provider
         
         OUTPUT:
         
         - ID of the forked kernel
         """
-        logger.debug("fork with rlimits %s", rlimits)
+        logger.debug("fork with profile %s", profile)
         id = str(uuid.uuid4())
-        kernel = KernelProcess(id, rlimits, self.dir, self.waiter_port)
+        settings = self.profiles[profile]
+        if zygote is not None:
+            kernel = PreparedKernel(
+                zygote, id, profile, settings, self.dir, self.waiter_port)
+        else:
+            cls = KernelProcess if settings.get("sage", True) \
+                else PythonKernelProcess
+            kernel = cls(id, profile, settings, self.dir, self.waiter_port)
+        kernel.start_time = time.time()
         kernel.start()
         self.kernels[id] = kernel
+        # Readable as soon as the kernel process exits.
+        self.loop.add_reader(kernel.sentinel, self.reap, kernel)
         return id
         
-    def kill_check(self):
+    def load(self):
+        r"""
+        Return the current load report for the dealer.
+        
+        OUTPUT:
+        
+        - dictionary with the number of live kernels, list of
+          ``[profile, number of preforked kernels]`` pairs, available memory
+          in bytes, the load average per CPU, the number of kernels that can
+          be requested now (credits), and the number of get requests received
+        """
+        return {
+            "kernels": len(self.kernels),
+            "preforked": [[profile, len(pool)]
+                          for profile, pool in self.preforked.items()],
+            "free_memory": psutil.virtual_memory().available,
+            "load": os.getloadavg()[0] / os.cpu_count(),
+            "capacity": sum(map(len, self.preforked.values()))
+                        + self.max_kernels
+                        - len(self.kernels) - len(self.requests)
+                        - sum(z.waiting for z in self.zygotes.values()),
+            "received": self.received,
+            "stats": self.stats,
+            "memory": self.memory,
+            }
+        
+    def report(self):
+        r"""
+        Send the load report to the dealer if our credits have changed.
+        
+        Reports are sent at least every ``report_interval`` seconds to let the
+        dealer know that we are alive.
+        """
+        load = self.load()
+        credits = load["capacity"], load["preforked"]
+        now = time.time()
+        if (credits != self.reported
+                or now >= self.report_time + self.report_interval):
+            self.dealer.send_json(["ready", load])
+            self.reported = credits
+            self.report_time = now
+        
+    def record_request(self, profile):
+        r"""
+        Update the arrival rate of requests for kernels of ``profile``.
+        
+        The rate decays exponentially with ``prefork_window`` time constant.
+        """
+        now = time.time()
+        self.request_rate[profile] = (self.current_rate(profile, now)
+                                      + 1 / self.prefork_window)
+        self.request_time[profile] = now
+        
+    def current_rate(self, profile, now=None):
+        if now is None:
+            now = time.time()
+        return self.request_rate[profile] * math.exp(
+            (self.request_time[profile] - now) / self.prefork_window)
+            
+    def preforked_target(self, profile):
+        r"""
+        Return the desired number of preforked kernels of ``profile``.
+        
+        The pool should cover the expected number of requests arriving while
+        a new kernel is forked, on top of ``min_preforked`` of the profile.
+        """
+        settings = self.profiles[profile]
+        expected = (self.current_rate(profile)
+                    * (self.fork_latency[profile] or 0))
+        target = settings["min_preforked"] + math.ceil(expected)
+        return max(settings["min_preforked"],
+                   min(target, settings["max_preforked"], self.max_kernels))
+        
+    def forking_count(self):
+        r"""
+        Return the number of kernels being started.
+        """
+        return len(self.forking) + sum(map(len, self.preforking.values()))
+        
+    def check_cpu_times(self):
+        r"""
+        Sample CPU times of kernels that the provider does not wait for.
+        
+        Their parent (the forkserver or a zygote) waits for them as soon as
+        they exit, so ``reap`` uses the last sample instead.
+        """
+        for kernel in self.kernels.values():
+            if kernel.pidfd is not None and send_signal(kernel, 0):
+                kernel.cpu_times = (process_times(kernel.pid)
+                                    or kernel.cpu_times)
+        
+    def check_zygotes(self):
+        r"""
+        Kill zygotes that take too long to run their setup code.
+        
+        Setup code gets ``setup_timeout`` seconds, and no more CPU time than
+        kernels of its profile: it could raise its own soft limits. Requests
+        waiting for killed zygotes fail, see ``lose_zygote``.
         """
-        Kill old kernels.
+        now = time.time()
+        for zygote in list(self.zygotes.values()):
+            if zygote.ready:
+                continue
+            limit = zygote.rlimits.get("RLIMIT_CPU")
+            times = process_times(zygote.pid) if limit else None
+            if times and times["utime"] + times["stime"] > limit:
+                logger.warning("setup code for %s exceeded CPU time limit",
+                               zygote.cls)
+                zygote.kill()
+            elif now - zygote.start_time > self.setup_timeout:
+                logger.warning("setup code for %s timed out", zygote.cls)
+                zygote.kill()
+        
+    def check_memory(self):
+        r"""
+        Measure memory used by the provider and its kernels.
+        
+        Private memory (USS) of kernels shows how much each additional kernel
+        costs, shared memory is mostly inherited from the provider.
         """
-        to_kill = []
-        for kernel in self.to_kill:
-            if kernel.is_alive():
-                if time.time() < kernel.deadline:
-                    to_kill.append(kernel)
-                    continue
+        total = collections.Counter()
+        for kernel in self.kernels.values():
+            usage = memory_usage(kernel.pid)
+            if usage is None:
+                continue
+            logger.debug("kernel %s memory %s", kernel.id, usage)
+            total.update(usage)
+            total["kernels"] += 1
+        self.memory = dict(total)
+        self.memory["provider"] = memory_usage(os.getpid())
+        if total["kernels"]:
+            logger.info("%d kernels use %d MiB privately (%d MiB each), "
+                        "%d MiB proportionally",
+                        total["kernels"], total["uss"] >> 20,
+                        total["uss"] // total["kernels"] >> 20,
+                        total["pss"] >> 20)
+        
+    def kill(self, kernel, expired=False):
+        r"""
+        Kill the process group of a kernel.
+        
+        This is called right after the kernel process exits or, if it
+        ignores SIGTERM, when its deadline expires.
+        """
+        timer = self.to_kill.pop(kernel, None)
+        if timer is not None:
+            timer.cancel()
+        if expired:
+            logger.warning("kernel process %d did not stop by deadline",
+                           kernel.pid)
+        try:
+            # Kernel PGID is the same as PID
+            os.killpg(kernel.pid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno !=  errno.ESRCH:
+                raise
+        logger.debug("killed kernel process group %d", kernel.pid)
+        if not self.is_active and not self.to_kill and not self.stopped.done():
+            self.stopped.set_result(None)
+        
+    def reap(self, kernel):
+        r"""
+        Handle the exit of a kernel process.
+        
+        Unexpected deaths of kernels given to the dealer are reported to it,
+        requested kernels that died before getting ready are forked again.
+        """
+        self.loop.remove_reader(kernel.sentinel)
+        if kernel.pidfd is None:
+            # CPU times are available until the process is waited for.
+            rusage = process_times(kernel.pid)
+        else:
+            rusage = kernel.cpu_times
+            os.close(kernel.pidfd)
+            kernel.pidfd = None
+        kernel.join()
+        if kernel in self.to_kill:
+            # Stopped on purpose, no need to wait for the deadline.
+            self.kill(kernel)
+            return
+        if self.kernels.get(kernel.id) is not kernel:
+            return  # Killed after its deadline.
+        del self.kernels[kernel.id]
+        reason = exit_reason(kernel.exitcode, kernel.rlimits, rusage)
+        logger.warning("kernel %s (process %d) died: %s",
+                       kernel.id, kernel.pid, reason)
+        # Kill whatever is left in its process group.
+        self.kill(kernel)
+        if kernel.id in self.forking:
+            self.forking.remove(kernel.id)
+            if isinstance(kernel, PreparedKernel):
+                zygote = self.zygotes.get(kernel.zygote.cls)
+                if zygote is not None:
+                    zygote.waiting += 1
                 else:
-                    logger.warning(
-                        "kernel process %d did not stop by deadline",
-                        kernel.pid)
-            try:
-                # Kernel PGID is the same as PID
-                os.killpg(kernel.pid, signal.SIGKILL)
-            except OSError as e:
-                if e.errno !=  errno.ESRCH:
-                    raise
-            logger.debug("killed kernel process group %d", kernel.pid)
-        self.to_kill = to_kill
+                    self.dealer.send_json(["failed", kernel.zygote.cls, 1])
+            else:
+                self.requests.appendleft(kernel.profile)
+        elif kernel.id in self.preforking[kernel.profile]:
+            self.preforking[kernel.profile].remove(kernel.id)
+        elif any(msg["id"] == kernel.id
+                 for msg in self.preforked[kernel.profile]):
+            self.preforked[kernel.profile] = [
+                msg for msg in self.preforked[kernel.profile]
+                if msg["id"] != kernel.id]
+        else:
+            self.dealer.send_json(["died", kernel.id,
+                {"exitcode": kernel.exitcode, "reason": reason}, rusage])
+        self.update()
+        
+    def return_kernel(self, id):
+        r"""
+        Put an unused or reset kernel back into the preforked pool.
+        
+        Kernels are stopped instead if the pool is full or they use more
+        memory than ``max_rss`` of their profile.
+        """
+        kernel = self.kernels.get(id)
+        if kernel is None:
+            logger.debug("kernel %s is already gone", id)
+            return
+        settings = self.profiles[kernel.profile]
+        usage = memory_usage(kernel.pid)
+        if isinstance(kernel, PreparedKernel):
+            # Its namespace is not clean.
+            self.stop_kernel(id)
+        elif usage and usage["rss"] > settings.get("max_rss", float("inf")):
+            logger.debug("kernel %s uses too much memory to be reused", id)
+            self.stop_kernel(id)
+        elif len(self.preforked[kernel.profile]) < settings["max_preforked"]:
+            logger.debug("kernel %s returned to the pool", id)
+            kernel.ready_time = time.time()
+            self.preforked[kernel.profile].append(kernel.info)
+        else:
+            self.stop_kernel(id)
+        
+    def reuse_kernel(self, id, uses):
+        r"""
+        Return a kernel that has been reset ``uses`` times to the pool.
+        """
+        kernel = self.kernels.get(id)
+        if kernel is not None:
+            kernel.uses = uses
+            # Startup phases have been accounted for already.
+            kernel.info["timings"] = {}
+        self.return_kernel(id)
         
     def send_kernel(self, msg):
+        kernel = self.kernels.get(msg["id"])
+        if kernel is not None:
+            msg["timings"]["pool"] = time.time() - kernel.ready_time
+            msg["uses"] = kernel.uses
         self.dealer.send_json(["kernel", msg])
+        
+    def serve_requests(self):
+        r"""
+        Start serving queued requests from the dealer in order, if possible.
+        
+        Preforked kernels are sent immediately, then kernels being preforked
+        are taken over, other requests wait for a free forking slot. If there
+        are too many kernels, a kernel from the largest pool of another
+        profile is killed to make room.
+        """
+        while self.requests:
+            profile = self.requests[0]
+            preforked = self.preforked[profile]
+            preforking = self.preforking[profile]
+            spare = max(self.preforked.values(), key=len)
+            if preforked:
+                self.send_kernel(preforked.pop(0))
+                self.stats["pool_hits"] += 1
+                logger.debug("%d preforked kernels of %s left",
+                             len(preforked), profile)
+            elif preforking:
+                self.forking.add(preforking.pop(0))
+                self.stats["prefork_takeovers"] += 1
+            elif self.forking_count() >= self.max_forking:
+                break
+            elif len(self.kernels) < self.max_kernels:
+                self.forking.add(self.fork(profile))
+                self.stats["cold_forks"] += 1
+            elif spare:
+                logger.warning("killing a preforked kernel to provide "
+                               "one of profile %s", profile)
+                self.stop_kernel(spare.pop(0)["id"])
+                self.forking.add(self.fork(profile))
+                self.stats["cold_forks"] += 1
+            else:
+                break
+            self.requests.popleft()
+        for zygote in list(self.zygotes.values()):
+            while (zygote.ready and zygote.waiting
+                   and self.forking_count() < self.max_forking
+                   and len(self.kernels) < self.max_kernels):
+                profile = zygote.cls.partition(":")[0]
+                try:
+                    id = self.fork(profile, zygote)
+                except (OSError, EOFError) as e:
+                    logger.warning("zygote for %s is gone: %s", zygote.cls, e)
+                    self.lose_zygote(zygote)
+                    break
+                self.forking.add(id)
+                self.stats["prepared_forks"] += 1
+                zygote.forked += 1
+                zygote.waiting -= 1
+            
+    def cancel_request(self, cls):
+        r"""
+        Forget a request of class ``cls`` that the dealer has given up on.
+        
+        Kernels that are being started already are not stopped, the dealer
+        returns them if nobody claims them.
+        """
+        zygote = self.zygotes.get(cls)
+        if zygote is not None and zygote.waiting:
+            zygote.waiting -= 1
+        elif cls in self.requests:
+            self.requests.remove(cls)
+            
+    def prepare(self, cls, code):
+        r"""
+        Return the zygote for requests of class ``cls``, start it if needed.
+        
+        INPUT:
+        
+        - ``cls`` - request class, ``"<profile>:<hash of code>"``
+        
+        - ``code`` - setup code to run in the zygote
+        
+        Idle zygotes beyond ``max_prepared`` are dropped, least recently used
+        first. They exit once all kernels forked from them do.
+        """
+        zygote = self.zygotes.get(cls)
+        if zygote is not None:
+            self.zygotes.move_to_end(cls)
+            return zygote
+        idle = [z for z in self.zygotes.values() if not z.waiting]
+        for old in idle[:max(0, len(self.zygotes) + 1 - self.max_prepared)]:
+            logger.debug("dropping zygote for %s", old.cls)
+            self.drop_zygote(old)
+        settings = self.profiles[cls.partition(":")[0]]
+        zygote = (PreparedZygote if settings.get("sage", True)
+                  else PythonPreparedZygote)(cls, code, settings)
+        zygote.start_time = time.time()
+        zygote.start()
+        zygote._connection.close()
+        self.zygotes[cls] = zygote
+        self.loop.add_reader(zygote.connection.fileno(),
+                             self.zygote_ready, zygote)
+        self.loop.add_reader(zygote.sentinel, self.reap_zygote, zygote)
+        logger.debug("started zygote %d for %s", zygote.pid, cls)
+        return zygote
+        
+    def zygote_ready(self, zygote):
+        self.loop.remove_reader(zygote.connection.fileno())
+        try:
+            zygote.connection.recv()
+        except (OSError, EOFError):
+            return  # It has died, reap_zygote will clean up.
+        zygote.ready = True
+        self.update()
+        
+    def drop_zygote(self, zygote):
+        if self.zygotes.pop(zygote.cls, None) is zygote:
+            if not zygote.ready:
+                self.loop.remove_reader(zygote.connection.fileno())
+            zygote.connection.close()
+        
+    def reap_zygote(self, zygote):
+        self.loop.remove_reader(zygote.sentinel)
+        zygote.join()
+        if self.zygotes.get(zygote.cls) is zygote:
+            logger.warning("zygote for %s died with exit code %s",
+                           zygote.cls, zygote.exitcode)
+            self.lose_zygote(zygote)
+            self.update()
+            
+    def lose_zygote(self, zygote):
+        r"""
+        Drop a zygote that has died and pass on the requests waiting for it.
+        
+        Zygotes that have forked kernels before are started again. Requests
+        for others are reported to the dealer as failed, since their setup
+        code is likely to blame.
+        """
+        self.drop_zygote(zygote)
+        if not zygote.waiting:
+            return
+        if zygote.forked:
+            self.prepare(zygote.cls, zygote.code).waiting += zygote.waiting
+        else:
+            logger.warning("failing %d requests for %s",
+                           zygote.waiting, zygote.cls)
+            self.dealer.send_json(["failed", zygote.cls, zygote.waiting])
+        zygote.waiting = 0
+
+    def update(self):
+        r"""
+        Serve requests, adjust the preforked pools, and report our credits.
+        
+        This is called after every event that may change the state.
+        """
+        if not self.is_active:
+            return
+        self.serve_requests()
+        # Prefork more kernels or shrink the pools.
+        for profile, preforked in self.preforked.items():
+            preforking = self.preforking[profile]
+            target = self.preforked_target(profile)
+            while (len(preforked) + len(preforking) < target
+                   and self.forking_count() < self.max_forking
+                   and len(self.kernels) < self.max_kernels):
+                preforking.append(self.fork(profile))
+            if (len(preforked) + len(preforking) > target
+                    and preforked and not self.requests):
+                logger.debug("shrinking the pool of %s kernels", profile)
+                self.stop_kernel(preforked.pop(0)["id"])
+        # Tell the dealer how many kernels we can provide.
+        self.report()
+        
+    def every(self, interval, callback):
+        r"""
+        Call ``callback`` now and then every ``interval`` seconds.
+        """
+        if self.is_active:
+            callback()
+            self.loop.call_later(interval, self.every, interval, callback)
+        
+    async def receive_requests(self):
+        r"""
+        Process requests from the dealer as soon as they arrive.
+        """
+        while True:
+            msg = await self.dealer.recv_json()
+            logger.debug("received %s", msg)
+            if msg == "disconnect":
+                self.stop()
+            elif msg[0] == "get":
+                # A batch of requests within credits we have reported.
+                # Requests for prepared kernels come with setup code.
+                self.received += len(msg[1])
+                for cls in msg[1]:
+                    if cls in msg[2]:
+                        self.prepare(cls, msg[2][cls]).waiting += 1
+                    else:
+                        self.requests.append(cls)
+                        self.record_request(cls)
+            elif msg[0] == "stop":
+                self.stop_kernel(msg[1])
+            elif msg[0] == "return":
+                self.return_kernel(msg[1])
+            elif msg[0] == "reuse":
+                self.reuse_kernel(msg[1], msg[2])
+            elif msg[0] == "interrupt":
+                self.interrupt_kernel(msg[1])
+            elif msg[0] == "cancel":
+                self.cancel_request(msg[1])
+            self.update()
+            
+    async def receive_kernels(self):
+        r"""
+        Process connection info from kernels that are ready.
+        """
+        while True:
+            msg = await self.waiter.recv_json()
+            kernel = self.kernels.get(msg["id"])
+            if kernel is None:
+                continue    # Stopped already.
+            kernel.info = msg
+            kernel.ready_time = time.time()
+            msg["timings"]["ready_send"] = kernel.ready_time - msg.pop("sent")
+            if not isinstance(kernel, PreparedKernel):
+                latency = kernel.ready_time - kernel.start_time
+                previous = self.fork_latency[kernel.profile]
+                self.fork_latency[kernel.profile] = latency \
+                    if previous is None else 0.8 * previous + 0.2 * latency
+            preforking = self.preforking[kernel.profile]
+            if kernel.id in self.forking:
+                self.send_kernel(msg)
+                self.forking.remove(kernel.id)
+            if kernel.id in preforking:
+                self.preforked[kernel.profile].append(msg)
+                preforking.remove(kernel.id)
+            self.update()
 
     def start(self):
+        asyncio.run(self.run())
+        
+    async def run(self):
+        r"""
+        Serve the dealer until stopped and all kernels are killed.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        self.dealer = zmq.asyncio.Socket.from_socket(self.dealer)
+        self.waiter = zmq.asyncio.Socket.from_socket(self.waiter)
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
         self.is_active = True
-        poller = zmq.Poller()
-        poller.register(self.dealer, zmq.POLLIN)
-        poller.register(self.waiter, zmq.POLLIN)
-        while self.is_active:
-            # For pretty red lines in the log
-            #logger.error("%s %s %s",
-            #    self.forking, self.preforking, self.to_kill)
-            
-            # Tell the dealer if we are ready.
-            if (not self.ready_sent
-                and self.forking is None
-                and (self.preforked or len(self.kernels) < self.max_kernels)):
-                self.dealer.send_json("ready")
-                self.ready_sent = True
-            # Kill old kernel process groups.
-            self.kill_check()
-            # Process requests from the dealer ...
-            events = dict(poller.poll(100))
-            if self.dealer in events:
-                msg = self.dealer.recv_json()
-                logger.debug("received %s", msg)
-                if msg == "disconnect":
-                    self.stop()
-                if msg[0] == "get":
-                    # We expect a single "get" for every "ready" sent.
-                    self.ready_sent = False
-                    if msg[1] == self.preforked_rlimits and self.preforked:
-                        self.send_kernel(self.preforked.pop(0))
-                        logger.debug("%d preforked kernels left",
-                                     len(self.preforked))
-                    elif msg[1] == self.preforked_rlimits and self.preforking:
-                        self.forking = self.preforking
-                        self.preforking = None
-                    else:
-                        if len(self.kernels) == self.max_kernels:
-                            logger.warning("killing a preforked kernel to "
-                                "provide a special one")
-                            self.stop_kernel(self.preforked.pop(0)["id"])
-                        self.forking = self.fork(msg[1])
-                if msg[0] == "stop":
-                    self.stop_kernel(msg[1])
-            # ... and connection info from kernels.
-            if self.waiter in events:
-                msg = self.waiter.recv_json()
-                if self.forking == msg["id"]:
-                    self.send_kernel(msg)
-                    self.forking = None
-                if self.preforking == msg["id"]:
-                    self.preforked.append(msg)
-                    self.preforking = None
-            # Prefork more standard kernels.
-            if (not (self.forking or self.preforking)
-                and len(self.preforked) < self.max_preforked
-                and len(self.kernels) < self.max_kernels):
-                self.preforking = self.fork(self.preforked_rlimits)
-        for id in list(self.kernels):
-            self.stop_kernel(id)
-        while self.to_kill:
-            self.kill_check()
-            time.sleep(0.1)
+        tasks = [asyncio.ensure_future(self.receive_requests()),
+                 asyncio.ensure_future(self.receive_kernels())]
+        self.every(self.report_interval, self.report)
+        self.every(self.memory_interval, self.check_memory)
+        self.every(self.cpu_sample_interval, self.check_cpu_times)
+        self.every(self.cpu_sample_interval, self.check_zygotes)
+        self.update()
+        await asyncio.wait(tasks + [self.stopped],
+                           return_when=asyncio.FIRST_COMPLETED)
+        # Stop if one of the tasks has crashed.
+        self.stop()
+        await self.stopped
+        for task in tasks:
+            if task.done():
+                task.result()
+            task.cancel()
             
     def stop(self):
+        if not self.is_active:
+            return
+        logger.info("shutting down")
         self.is_active = False
+        for id in list(self.kernels):
+            self.stop_kernel(id)
+        for zygote in list(self.zygotes.values()):
+            self.drop_zygote(zygote)
+        if not self.to_kill:
+            self.stopped.set_result(None)
+        
+    def interrupt_kernel(self, id):
+        r"""
+        Send SIGINT to the process group of a kernel.
+        
+        IPython kernels turn it into ``KeyboardInterrupt`` while executing
+        code and ignore it otherwise.
+        """
+        kernel = self.kernels.get(id)
+        if kernel is None:
+            logger.debug("kernel %s is already gone", id)
+            return
+        if not send_signal(kernel, 0):
+            logger.debug("kernel %s has exited already", id)
+            return
+        logger.debug("interrupting kernel process group %d", kernel.pid)
+        try:
+            os.killpg(kernel.pid, signal.SIGINT)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
         
     def stop_kernel(self, id):
-        kernel = self.kernels.pop(id)
-        if kernel.is_alive():
-            logger.debug("killing kernel process %d", kernel.pid)
-            os.kill(kernel.pid, signal.SIGTERM)
-        kernel.deadline = time.time() + 1
-        self.to_kill.append(kernel)
+        kernel = self.kernels.pop(id, None)
+        if kernel is None:
+            logger.debug("kernel %s is already gone", id)
+            return
+        # Kernels forked by the provider are not waited for yet, so their PID
+        # cannot be reused. Other kernels are signaled via their pidfd.
+        logger.debug("killing kernel process %d", kernel.pid)
+        send_signal(kernel, signal.SIGTERM)
+        # Escalate to SIGKILL unless the process exits before that.
+        self.to_kill[kernel] = self.loop.call_later(
+            1, self.kill, kernel, True)
+
+
+def open_pidfd(pid):
+    r"""
+    Return a pidfd for a process, or ``None`` if it is not available.
+    
+    Signals sent via a pidfd cannot hit another process that got the PID of
+    an exited one, which matters for processes waited for by others.
+    """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError) as e:
+        logger.debug("no pidfd for process %d: %s", pid, e)
+        return None
+
+
+def send_signal(kernel, signum):
+    r"""
+    Send ``signum`` to a kernel process, via its pidfd if it has one.
+    
+    OUTPUT:
+    
+    - ``False`` if the process does not exist anymore
+    """
+    try:
+        if kernel.pidfd is not None:
+            signal.pidfd_send_signal(kernel.pidfd, signum)
+        else:
+            os.kill(kernel.pid, signum)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def process_times(pid):
+    r"""
+    Return user and system CPU time of a process, even if it has exited.
+    
+    OUTPUT:
+    
+    - dictionary with keys ``utime`` and ``stime`` in seconds, or ``None`` if
+      the process has been waited for already
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            # The command name may contain spaces.
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    tick = os.sysconf("SC_CLK_TCK")
+    return {"utime": int(fields[11]) / tick, "stime": int(fields[12]) / tick}
+
+
+def memory_usage(pid):
+    r"""
+    Return memory usage of a process from ``/proc/<pid>/smaps_rollup``.
+    
+    OUTPUT:
+    
+    - dictionary with ``rss``, ``pss``, ``uss`` (private), and ``shared``
+      memory in bytes, or ``None`` if it is not available
+    """
+    fields = {}
+    try:
+        with open("/proc/{}/smaps_rollup".format(pid)) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        }
+
+
+def exit_reason(exitcode, rlimits, rusage):
+    r"""
+    Return a human readable reason of a kernel process exit.
+    """
+    if exitcode is None:
+        return "exit status unknown"
+    if exitcode == 0:
+        return "normal exit"
+    if exitcode > 0:
+        return "exit with status {}".format(exitcode)
+    signum = -exitcode
+    cpu_limit = rlimits.get("RLIMIT_CPU")
+    if signum == signal.SIGXCPU or (
+            signum == signal.SIGKILL and cpu_limit and rusage
+            and rusage["utime"] + rusage["stime"] >= cpu_limit - 1):
+        return "CPU time limit exceeded"
+    if signum == signal.SIGKILL:
+        return "killed (possibly out of memory)"
+    return "killed by {}".format(signal.Signals(signum).name)
 
             
 def setup_sage():
@@ -275,16 +1161,37 @@ def setup_sage():
         pylab.show = partial(mp_show, savefig=pylab.savefig)
         matplotlib.pyplot.show = partial(mp_show, savefig=matplotlib.pyplot.savefig)
 
-    # The first plot takes about 2 seconds to generate (presumably
-    # because lots of things, like matplotlib, are imported).  We plot
-    # something here so that worker processes don't have this overhead
-    try:
-        from sage.plot.all import plot
-        plot(1, (0, 1))
-    except ImportError:
-        pass
-    except Exception:
-        logger.exception("plotting exception")
+
+def warm_up(snippets):
+    r"""
+    Run code snippets to pay first-use costs once, before forking kernels.
+    
+    For example, the first plot takes about 2 seconds to generate (presumably
+    because lots of things, like matplotlib, are imported). Each snippet is
+    executed in a fresh namespace, failures are logged and otherwise ignored.
+    
+    INPUT:
+    
+    - ``snippets`` - list of strings with Python code
+    """
+    for code in snippets:
+        before = memory_usage(os.getpid())
+        start = time.time()
+        try:
+            exec(code, {})
+        except ImportError as e:
+            logger.warning("cannot warm up with %r: %s", code, e)
+            continue
+        except Exception:
+            logger.exception("warm-up exception in %r", code)
+            continue
+        duration = time.time() - start
+        after = memory_usage(os.getpid())
+        if before and after:
+            logger.info("warm-up %r took %.3f s, RSS grew by %d KiB",
+                        code, duration, (after["rss"] - before["rss"]) >> 10)
+        else:
+            logger.info("warm-up %r took %.3f s", code, duration)
 
 
 def main():
@@ -308,12 +1215,6 @@ def main():
         address = "[{}]".format(address)
     address = "tcp://{}:{}".format(address, args.port)
     provider = KernelProvider(address, args.dir)
-
-    def signal_handler(signum, frame):
-        logger.info("received %s, shutting down", signum)
-        provider.stop()
-
-    signal.signal(signal.SIGTERM, signal_handler)
     provider.start()
 
 
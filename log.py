@@ -42,8 +42,8 @@ class TornadoFilter(logging.Filter):
     Drop HA-Proxy healthchecks.
     """
     def filter(self, record):
-        return len(record.args) != 3 or \
-            record.args[:2] != (200, 'OPTIONS / (10.0.3.1)')
+        return len(record.args) != 3 or record.args[:2] not in [
+            (200, 'OPTIONS / (10.0.3.1)'), (200, 'GET /health (10.0.3.1)')]
 
 logging.getLogger("tornado.access").addFilter(TornadoFilter())
 
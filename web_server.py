@@ -12,6 +12,8 @@ asyncio.set_event_loop(asyncio.new_event_loop())
 
 import psutil
 import tornado.ioloop
+import tornado.iostream
+import tornado.tcpserver
 import tornado.web
 
 from . import handlers
@@ -54,6 +56,32 @@ def start_providers(port, providers, dir):
         client.close()
 
 
+class AgentCheckServer(tornado.tcpserver.TCPServer):
+    r"""
+    HAProxy agent-check listener reporting free kernel capacity.
+    
+    Each connection gets one line, ``ready <weight>%`` with the weight from
+    ``KernelDealer.capacity_weight`` (at least 1%), or ``drain`` if no
+    kernel provider is live, so that only sticky sessions stay here.
+    """
+    
+    def __init__(self, kernel_dealer):
+        super(AgentCheckServer, self).__init__()
+        self.kernel_dealer = kernel_dealer
+        
+    async def handle_stream(self, stream, address):
+        weight = self.kernel_dealer.capacity_weight()
+        if weight is None:
+            reply = "drain\n"
+        else:
+            reply = "ready {}%\n".format(max(weight, 1))
+        try:
+            await stream.write(reply.encode())
+        except tornado.iostream.StreamClosedError:
+            pass
+        stream.close()
+
+
 class SageCellServer(tornado.web.Application):
     def __init__(self, baseurl, dir):
         # This matches a kernel id (uuid4 format) from a url
@@ -64,9 +92,12 @@ class SageCellServer(tornado.web.Application):
             (r"/embedded_sagecell.js",
              tornado.web.RedirectHandler,
              {"url":baseurl+"/static/embedded_sagecell.js"}),
+            (r"/health", handlers.HealthHandler),
             (r"/help.html", handlers.HelpHandler),
             (r"/kernel", handlers.KernelHandler),
             (r"/kernel/%s" % _kernel_id_regex, handlers.KernelHandler),
+            (r"/kernel/%s/interrupt" % _kernel_id_regex,
+             handlers.InterruptHandler),
             (r"/kernel/%s/channels" % _kernel_id_regex,
              handlers.WebChannelsHandler),
             (r"/kernel/%s/files/(?P<file_path>.*)" % _kernel_id_regex,
@@ -88,6 +119,10 @@ class SageCellServer(tornado.web.Application):
         self.kernel_dealer = KernelDealer(config.get("provider_settings"))
         start_providers(self.kernel_dealer.port, config.get("providers"), dir)
         self.completer = handlers.Completer(self.kernel_dealer)
+        self.health_checker = handlers.HealthChecker(self.kernel_dealer)
+        self.output_cache = None
+        if config.get("permalink_output_cache"):
+            self.output_cache = handlers.OutputCache(dir)
         db = importlib.import_module('sagecell.db_' + config.get('db'))
         self.db = db.DB(config.get('db_config')['uri'])
         self.ioloop = tornado.ioloop.IOLoop.current()
@@ -170,6 +205,10 @@ def main():
     signal.signal(signal.SIGTERM, handler)
 
     app.listen(**listen)
+    agent_port = config.get("haproxy_agent_port")
+    if agent_port:
+        AgentCheckServer(app.kernel_dealer).listen(
+            agent_port, listen.get('address', ''))
     app.ioloop.start()
     pidlock.release()
     logger.info('SageCell server stopped')